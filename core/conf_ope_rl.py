@@ -9,11 +9,13 @@ import gurobipy as gp
 from joblib import Parallel, delayed
 from copy import deepcopy
 import cvxpy as cvx
-from scipy.sparse import lil_matrix
+from scipy.sparse import lil_matrix, csr_matrix
+from scipy.linalg import lu_factor, lu_solve
 #import mosek
 from datetime import datetime
 import pickle
 from numba import jit
+from trajstore import TrajStore
 
 
 
@@ -86,25 +88,57 @@ def simulate_multinomial(vmultinomial):
     nextState=m[len(m)-1]
     return nextState
 
-#@jit
+def get_pib_counts_idx(nA,nS, a_s, s_idx): 
+    '''
+    # counts of (a, s), nA by nS, from integer actions and states
+    '''
+    return np.bincount(np.asarray(s_idx, dtype=int) * nA + np.asarray(a_s, dtype=int),
+                       minlength=nS*nA).reshape([nS, nA]).T.astype(float)
+
+def get_pib_idx(nA,nS, a_s, s_idx): 
+    '''
+    # estimate p(a \mid s) from integer actions and states, nan for unvisited s
+    '''
+    counts = get_pib_counts_idx(nA,nS, a_s, s_idx)
+    return counts / counts.sum(axis=0)
+
+# stateHist is one-hot (n+1 by nS), a_s the n actions taken from stateHist[:-1]
 def get_pib(nA,nS, a_s, stateHist): 
     '''
     # estimate p(a \mid s)
     '''
-    p_a1_su = np.zeros([nA, nS])
-    for a in range(nA): 
-        p_a1_su[a,:] = [sum( (a_s==a) & (stateHist[:-1,s]==1) ) / sum(stateHist[:-1,s]) for s in range(nS)]
-    return p_a1_su
+    return get_pib_idx(nA,nS, a_s, stateHist[:-1].argmax(axis=1))
 
-#@jit
 def get_pib_counts(nA,nS, a_s, stateHist): 
     '''
     # estimate counts of p(a \mid s)
     '''
-    p_a1_su_counts = np.zeros([nA, nS])
-    for a in range(nA): 
-        p_a1_su_counts[a,:] = [sum( (a_s==a) & (stateHist[:-1,s]==1) )  for s in range(nS)]
-    return p_a1_su_counts
+    return get_pib_counts_idx(nA,nS, a_s, stateHist[:-1].argmax(axis=1))
+
+class PibCounter(object):
+    '''
+    Running (a, s) counts over trajectories, on the full states and, with nU,
+    on the marginal states s // nU
+    '''
+    def __init__(self, nA, nS, nU=None):
+        self.nA = nA; self.nS = nS; self.nU = nU
+        self.counts = np.zeros([nA, nS])
+
+    def add(self, a_s, s_idx):
+        self.counts += get_pib_counts_idx(self.nA, self.nS, a_s, s_idx)
+
+    def add_counts(self, a_s_counts):
+        self.counts += a_s_counts
+
+    def agg_counts(self):
+        return reshape_byxrow(self.counts.T, self.nU).T
+
+    def pib(self):
+        return self.counts / self.counts.sum(axis=0)
+
+    def pib_agg(self):
+        counts = self.agg_counts()
+        return counts / counts.sum(axis=0)
 
 #@jit
 def get_cndl_s_a_sprime(s_a_sprime, distrib):
@@ -155,6 +189,92 @@ def simulate_rollouts( nS, nA, P, Pi, state_dist, n ):
 
     return [ stateChangeHist, stateHist, a_s, s_a_sprime, distrib, distr_hist ]
 
+@jit(nopython=True, cache=True)
+def _draw_cdf(cdf, r):
+    # first index with cdf > r (binary search, cdf normalized to end at 1)
+    lo = 0; hi = len(cdf) - 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if cdf[mid] > r:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+@jit(nopython=True, cache=True)
+def _rollout_chunk(P_cdf, Pi_cdf, s, rands, stateChangeHist, s_a_sprime, a_s_counts, state_counts):
+    for x in range(rands.shape[0]):
+        a = _draw_cdf(Pi_cdf[s], rands[x, 0])
+        sp = _draw_cdf(P_cdf[s, a], rands[x, 1])
+        a_s_counts[a, s] += 1
+        stateChangeHist[s, sp] += 1
+        s_a_sprime[s, a, sp] += 1
+        state_counts[sp] += 1
+        s = sp
+    return s
+
+def _normalized_cdf(p):
+    cdf = np.cumsum(p, axis=-1)
+    tot = cdf[..., -1:]
+    return np.ascontiguousarray(cdf / np.where(tot > 0, tot, 1))
+
+# Streaming version of simulate_rollouts for long chains (10^6+ steps): only
+# running counts are kept, O(n) time and O(nS^2 nA) memory.
+# Returns [ stateChangeHist, state_counts, a_s_counts, s_a_sprime, distrib, distr_hist ]
+#   state_counts   visits of the n+1 states, including s0
+#   a_s_counts     nA by nS counts of the action taken in each state
+#   distr_hist     running distribution every snapshot_every steps (first row
+#                  zeros as in simulate_rollouts), empty without snapshot_every
+# Unlike simulate_rollouts the chain starts from the sampled s0.
+def simulate_rollouts_streaming( nS, nA, P, Pi, state_dist, n, snapshot_every=None, chunk=2**16 ):
+    stateChangeHist = np.zeros([nS,nS])
+    s_a_sprime = np.zeros([nS,nA,nS])
+    a_s_counts = np.zeros([nA,nS])
+    state_counts = np.zeros(nS)
+    P_cdf = _normalized_cdf(P)
+    Pi_cdf = _normalized_cdf(Pi.T)
+    currentState = np.random.choice(nS, p = state_dist)
+    state_counts[currentState] += 1
+    if snapshot_every is not None:
+        chunk = snapshot_every
+    distr_hist = [ np.zeros(nS) ]
+
+    done = 0
+    while done < n:
+        m = min(chunk, n - done)
+        currentState = _rollout_chunk(P_cdf, Pi_cdf, currentState, np.random.uniform(size=(m, 2)),
+                                      stateChangeHist, s_a_sprime, a_s_counts, state_counts)
+        done += m
+        if snapshot_every is not None:
+            distr_hist.append(state_counts / state_counts.sum())
+    distrib = np.reshape(state_counts / state_counts.sum(), (1,nS))
+    distr_hist = np.array(distr_hist) if snapshot_every is not None else np.zeros([0,nS])
+
+    return [ stateChangeHist, state_counts, a_s_counts, s_a_sprime, distrib, distr_hist ]
+
+@jit(nopython=True, cache=True)
+def _rollout_seq(P_cdf, Pi_cdf, s, rands, states, actions):
+    states[0] = s
+    for x in range(rands.shape[0]):
+        a = _draw_cdf(Pi_cdf[s], rands[x, 0])
+        s = _draw_cdf(P_cdf[s, a], rands[x, 1])
+        actions[x] = a
+        states[x+1] = s
+    return s
+
+# Rollout kept as a compact TrajStore (one trajectory of n steps) instead of
+# the one-hot stateHist; starts from the sampled s0 like simulate_rollouts_streaming
+def simulate_rollouts_store( nS, nA, P, Pi, state_dist, n ):
+    states = np.zeros(n+1, dtype=np.int64); actions = np.zeros(n, dtype=np.int64)
+    s0_ = np.random.choice(nS, p = state_dist)
+    _rollout_seq(_normalized_cdf(P), _normalized_cdf(Pi.T), s0_, np.random.uniform(size=(n, 2)), states, actions)
+    return TrajStore.from_state_seq(states, actions, nStates=nS, nActions=nA)
+
+# Converts simulate_rollouts output to a TrajStore
+def rollout_to_store(res, nA, nS):
+    [ stateChangeHist, stateHist, a_s, s_a_sprime, distrib, distr_hist ] = res
+    return TrajStore.from_state_seq(stateHist.argmax(axis=1), a_s, nStates=nS, nActions=nA)
+
 #@jit
 def agg_state(nS,nSmarg,nU,nA,s_a_sprime):
     ''' Aggregate every nSmarg states 
@@ -198,37 +318,22 @@ def get_auxiliary_info_from_traj(stateChangeHist, stateHist, a_s, s_a_sprime, di
 
 #@jit
 def get_agg_auxiliary_info_from_all_trajectories(res, nA,nS, nSmarg, nU): 
-    # s_a_sprime_cum = np.zeros([nS,nA,nS])
     # assume all trajectories of same length
-    # better to compute running averages rather than 
-    [ stateChangeHist, stateHist, a_s, s_a_sprime, distrib, distr_hist ] = res[0] 
+    # (a, s) counts are accumulated on state indices, the marginal counts and
+    # s-a-s' aggregation are taken once at the end (both are linear)
     N = len(res); 
-    s_a_sprime_cum = s_a_sprime
-    p_a1_su = get_pib_counts(nA,nS, a_s, stateHist); 
-
-    aggStateHist = reshape_byxrow(stateHist.T, nU).T; 
-    agg_s_a_sprime_cum = agg_state(nS,nSmarg,nU,nA,s_a_sprime)
-    p_a1_s = get_pib_counts(nA,nSmarg, a_s, aggStateHist); 
-    i = 0
-    # totals=np.sum(stateHist,axis=0); gt=np.sum(totals); distrib=totals/gt; distrib=np.reshape(distrib,(1,nS))
-    for traj in res[1:]: 
+    counter = PibCounter(nA, nS, nU)
+    s_a_sprime_cum = np.zeros([nS,nA,nS]); distrib = np.zeros([1,nS])
+    for i, traj in enumerate(res): 
         if i%100==0: 
             print(i)
-        i+=1; 
         [ stateChangeHist_, stateHist_, a_s_, s_a_sprime_, distrib_, distr_hist ] = traj 
-        p_a1_su_ = get_pib_counts(nA,nS, a_s_, stateHist_) # takes too much memory to store history  # stateHist = np.vstack([stateHist, stateHist_])        # a_s = np.vstack([a_s, a_s_.reshape([len(a_s_),1]) ])
-        # append 
-        s_a_sprime_cum = s_a_sprime_cum + s_a_sprime_; p_a1_su += p_a1_su_; distrib += distrib_
-        # aggregate history online 
-        aggStateHist_ = reshape_byxrow(stateHist_.T, nU).T
-        agg_s_a_sprime_ = agg_state(nS,nSmarg,nU,nA,s_a_sprime_)
-        p_a1_s_ = get_pib_counts(nA,nSmarg, a_s, aggStateHist_)
-        agg_s_a_sprime_cum = agg_s_a_sprime_cum + agg_s_a_sprime_; p_a1_s += p_a1_s_
+        counter.add(a_s_, stateHist_[:-1].argmax(axis=1))
+        s_a_sprime_cum = s_a_sprime_cum + s_a_sprime_; distrib = distrib + distrib_
+    agg_s_a_sprime_cum = agg_state(nS,nSmarg,nU,nA,s_a_sprime_cum)
     # take average over trajectories
     distrib = (distrib / distrib.sum()) ; # p_infty_b_su
-    # print distrib
-    p_a1_su = p_a1_su / N; p_a1_su = p_a1_su/ p_a1_su.sum(axis=0) # return probabilities
-    p_a1_s = p_a1_s / N; p_a1_s = p_a1_s/ p_a1_s.sum(axis=0)
+    p_a1_su = counter.pib(); p_a1_s = counter.pib_agg() # return probabilities
     # print ((s_a_sprime_cum/s_a_sprime_cum.sum())/distrib)[:,:,0]
     [joint_s_a_sprime, s_a_giv_sprime] = get_cndl_s_a_sprime(s_a_sprime_cum, distrib.flatten())
 
@@ -238,6 +343,45 @@ def get_agg_auxiliary_info_from_all_trajectories(res, nA,nS, nSmarg, nU):
 
     return [ p_a1_su, joint_s_a_sprime, s_a_giv_sprime, s_a_sprime_cum, p_a1_s, joint_s_a_sprime_agg, s_a_giv_sprime_agg, agg_s_a_sprime_cum, distrib]
 
+# Same as get_auxiliary_info_from_traj for the output of simulate_rollouts_streaming
+def get_auxiliary_info_from_stats(stateChangeHist, state_counts, a_s_counts, s_a_sprime, distrib, distr_hist, nA,nS): 
+    p_a1_su = a_s_counts / a_s_counts.sum(axis=0)
+    [joint_s_a_sprime, s_a_giv_sprime] = get_cndl_s_a_sprime(s_a_sprime, distrib)
+    return [ p_a1_su, joint_s_a_sprime, s_a_giv_sprime ]
+
+# Same as get_auxiliary_info_from_traj for a TrajStore; with nU also returns
+# the policy on the marginal states (store.agg(nU) replaces reshape_byxrow)
+def get_auxiliary_info_from_store(store, nA,nS, nU=None): 
+    p_a1_su = get_pib_idx(nA,nS, store.a.ravel(), store.s.ravel())
+    state_counts = store.state_counts()
+    [joint_s_a_sprime, s_a_giv_sprime] = get_cndl_s_a_sprime(store.s_a_sprime(), state_counts / state_counts.sum())
+    if nU is None:
+        return [ p_a1_su, joint_s_a_sprime, s_a_giv_sprime ]
+    agg = store.agg(nU)
+    p_a1_s = get_pib_idx(nA,agg.nStates, agg.a.ravel(), agg.s.ravel())
+    return [ p_a1_su, joint_s_a_sprime, s_a_giv_sprime, p_a1_s ]
+
+# Same as get_agg_auxiliary_info_from_all_trajectories for a list of
+# simulate_rollouts_streaming outputs. Counts are summed first and aggregated
+# once (agg_state is linear); the aggregated policy uses each trajectory's
+# own actions.
+def get_agg_auxiliary_info_from_all_stats(res, nA,nS, nSmarg, nU): 
+    counter = PibCounter(nA, nS, nU)
+    s_a_sprime_cum = np.zeros([nS,nA,nS]); distrib = np.zeros([1,nS])
+    for traj in res: 
+        [ stateChangeHist_, state_counts_, a_s_counts_, s_a_sprime_, distrib_, distr_hist_ ] = traj 
+        counter.add_counts(a_s_counts_)
+        s_a_sprime_cum = s_a_sprime_cum + s_a_sprime_; distrib += distrib_
+    distrib = (distrib / distrib.sum())
+    p_a1_su = counter.pib(); p_a1_s = counter.pib_agg()
+    agg_s_a_sprime_cum = agg_state(nS,nSmarg,nU,nA,s_a_sprime_cum)
+    [joint_s_a_sprime, s_a_giv_sprime] = get_cndl_s_a_sprime(s_a_sprime_cum, distrib.flatten())
+
+    p_infty_b_s = (reshape_byxrow(distrib.T,nU).T ).flatten()
+    [joint_s_a_sprime_agg, s_a_giv_sprime_agg] = get_cndl_s_a_sprime(agg_s_a_sprime_cum, p_infty_b_s)
+
+    return [ p_a1_su, joint_s_a_sprime, s_a_giv_sprime, s_a_sprime_cum, p_a1_s, joint_s_a_sprime_agg, s_a_giv_sprime_agg, agg_s_a_sprime_cum, distrib]
+
 ## deprecated version that keeps things in memory
 # def get_auxiliary_info_from_all_trajectories(res, nA,nS): 
 
@@ -377,6 +521,12 @@ def random_g(a_bnd,b_bnd):
         g[k,:,:] = a_bnd + draw
     return g
 
+# R draws of random_g stacked, R by nS by nA by nS
+def random_gs(a_bnd,b_bnd,R): 
+    [nA,nS] = a_bnd.shape
+    draw = np.random.uniform(size = (R,) + a_bnd.shape) * (b_bnd - a_bnd)
+    return np.repeat((a_bnd + draw)[:,None], nS, axis=1)
+
 #@jit
 def obj_eval(g, *args): 
     ''' Evaluate objective
@@ -384,50 +534,163 @@ def obj_eval(g, *args):
     '''
     data = args[0]
     Phi = data['Phi'] # state
-    p_infty_b_s = data['pbs'] 
-    nSmarg = len(p_infty_b_s)
-    s_a_giv_sprime = data['s_a_giv_sprime'] 
-    p_e_s = data['p_e_s'];     nA = len(p_e_s); check_grad = data['check_grad']
-    A = np.zeros([nSmarg,nSmarg])
-    for k in range(nSmarg): 
-        for j in range(nSmarg): 
-            A[k,j] += sum( [ s_a_giv_sprime[j,a,k]*p_infty_b_s[k] * (p_e_s[a,j] *g[k,a,j] ) for a in range(nA)] )
-        A[k,k] -= p_infty_b_s[k]
-    tildeA = A
-    # Make regular and add normalization 
-    tildeA[-1,:] = p_infty_b_s
-    v = np.zeros([nSmarg]); v[-1] = 1 
-    theta = np.linalg.inv(tildeA).dot(v)
+    check_grad = data['check_grad']
+    tildeA = obj_A(g, data)
+    # one factorization per iterate, reused by grad_H_wrt_g for the adjoint solve
+    lu = lu_factor(tildeA)
+    data['A_lu'] = (tildeA, lu)
+    theta = obj_theta(lu)
     if check_grad: 
         return Phi.dot(theta)
     return [Phi.dot(theta), theta, tildeA]
 
+# coefficients of A in g, C[k,a,j] = P(s=j,a | s'=k) p_b(k) pi_e(a|j)
+def obj_coefs(data):
+    return proj_g_coefs(data) * data['p_e_s'][None,:,:]
+
+# A[k,j] = sum_a C[k,a,j] g[k,a,j] - p_b(k) I[k=j], with the last row
+# replaced by the normalization p_b; g may be stacked, R by nS by nA by nS
+def obj_A(g, data, coefs=None):
+    if coefs is None:
+        coefs = obj_coefs(data)
+    p_infty_b_s = data['pbs']
+    nS = len(p_infty_b_s)
+    A = np.einsum('kaj,...kaj->...kj', coefs, g)
+    A[..., np.arange(nS), np.arange(nS)] -= p_infty_b_s
+    A[..., -1, :] = p_infty_b_s
+    return A
+
+# theta = A^{-1} e_last
+def obj_theta(lu):
+    v = np.zeros(len(lu[1])); v[-1] = 1
+    return lu_solve(lu, v)
+
+# d(Phi theta)/dg[k,a,j] = -(A^{-T} Phi)_k theta_j C[k,a,j], zero on the
+# normalization row k = |S|
+def obj_grad(lu, theta, Phi, coefs):
+    return obj_grad_adjoint(lu_solve(lu, Phi, trans=1), theta, coefs)
+
+# same from the adjoint lam = A^{-T} Phi, stacked over leading axes
+def obj_grad_adjoint(lam, theta, coefs):
+    lam = lam.copy(); lam[..., -1] = 0
+    return -(lam[...,:,None,None] * theta[...,None,None,:]) * coefs
+
 
 #@jit
 def grad_H_wrt_g(g, *args): 
     ''' Evaluate gradient
     Assume g is [k,a,j]
-     -({I}[j /= |S|]  pi^e_a,j Pb_{j,a,k}) (\E[A']^{-\top } \Phi \theta^\top)_{i,j}
+     -({I}[k /= |S|]  pi^e_a,j Pb_{j,a,k}) (\E[A']^{-\top } \Phi \theta^\top)_{k,j}
 
-    Build A matrix explicitly 
+    Reuses the LU factorization from obj_eval when data['A'] is that matrix
     '''
     data = args[0]
     A = data['A']
     theta = data['theta']
     Phi = data['Phi']
-    outer_ = np.outer(Phi, theta)
-    M = np.linalg.inv(A).dot(outer_)
-    g_grad = np.zeros(g.shape)
-    s_a_giv_sprime = data['s_a_giv_sprime'] ;p_e_s = data['p_e_s'];    p_infty_b_s = data['pbs'] 
-    for k in range(g_grad.shape[0]): 
-        for a in range(g_grad.shape[1]): 
-            for j in range(g_grad.shape[2])[:-1]: # omit last row of J  
-                g_grad[k,a,j] = M[j,k]*s_a_giv_sprime[j,a,k]*p_infty_b_s[k]*p_e_s[a,j]
-    return g_grad
+    cached = data.get('A_lu')
+    lu = cached[1] if cached is not None and cached[0] is A else lu_factor(A)
+    return obj_grad(lu, theta, Phi, obj_coefs(data))
 
 #@jit
 def proj_g_(g_tilde, *args): 
     ''' Project a given g vector onto feasible vector 
+    Closed form (proj_g_bisect), with the Gurobi QP (proj_g_gurobi) as fallback
+    or when data['proj_solver'] == 'gurobi'
+    '''
+    data = args[0]
+    if data.get('proj_solver', 'bisect') == 'bisect':
+        [g_, obj] = proj_g_bisect(g_tilde, data)
+        if g_ is not None and proj_g_residual(g_, data) <= 1e-8:
+            return [g_, obj]
+    return proj_g_gurobi(g_tilde, data)
+
+# coefficients of the normalization constraints, c[k,a,j] = P(s=j,a | s'=k) p_b(k)
+def proj_g_coefs(data):
+    return data['s_a_giv_sprime'].transpose(2,1,0) * data['pbs'][:,None,None]
+
+# max violation of sum_{k,j} c[k,a,j] g[k,a,j] = 1 (within epsilon if not tight)
+def proj_g_residual(g, data):
+    eps = 0 if data['tight'] else data.get('epsilon', 0)
+    resid = np.abs((proj_g_coefs(data) * g).sum(axis=(0,2)) - 1)
+    return np.max(np.maximum(resid - eps, 0))
+
+# proj_g_ over a stack of g's, R by nS by nA by nS. Restarts where the closed
+# form misses the constraints go through the Gurobi QP one at a time; returns
+# the projections and which restarts are feasible
+def proj_g_batch(gs_tilde, data):
+    if data.get('proj_solver', 'bisect') == 'bisect':
+        [gs, obj, feasible] = proj_g_bisect_batch(gs_tilde, data)
+        eps = 0 if data['tight'] else data.get('epsilon', 0)
+        resid = np.abs(np.einsum('kaj,rkaj->ra', proj_g_coefs(data), gs) - 1)
+        redo = feasible & (np.maximum(resid - eps, 0).max(1) > 1e-8)
+    else:
+        gs = np.array(gs_tilde, dtype=float); feasible = np.ones(len(gs), dtype=bool)
+        redo = feasible.copy()
+    for r in np.where(redo)[0]:
+        [g_, obj] = proj_g_gurobi(gs_tilde[r], data)
+        feasible[r] = g_ is not None
+        if g_ is not None:
+            gs[r] = g_
+    return [gs, feasible]
+
+#@jit
+def proj_g_bisect(g_tilde, *args): 
+    ''' Euclidean projection onto the box a_bnd <= g[k,a,:] <= b_bnd intersected
+    with one hyperplane per action. The actions decouple; for each the solution
+    is clip(g_tilde + lam*c, lo, hi), where the multiplier lam solves a monotone
+    piecewise linear equation. Solved by vectorized bisection over the actions,
+    then exactly on the final active set. Returns [None, None] if infeasible.
+    '''
+    data = args[0] 
+    [g_, obj, feasible] = proj_g_bisect_batch(g_tilde[None], data)
+    if not feasible[0]:
+        return [None, None]
+    return [g_[0], obj[0]]
+
+# proj_g_bisect for a stack of g's, R by nS by nA by nS; returns the
+# projections, the squared distances and which restarts are feasible
+def proj_g_bisect_batch(gs_tilde, data):
+    [R, nS, nA] = gs_tilde.shape[:3]
+    c = proj_g_coefs(data)
+    lo = np.broadcast_to(data['a_bnd'][None], c.shape)
+    hi = np.broadcast_to(data['b_bnd'][None], c.shape)
+    # actions first, flattened over (k, j)
+    c, lo, hi = [x.transpose(1,0,2).reshape([nA, -1]) for x in (c, lo, hi)]
+    gt = gs_tilde.transpose(0,2,1,3).reshape([R, nA, -1])
+    f = lambda lam: (c * np.clip(gt + lam[...,None]*c, lo, hi)).sum(-1)
+    # target: 1, or the nearest end of [1-eps, 1+eps] when not tight
+    eps = 0 if data['tight'] else data.get('epsilon', 0)
+    zero = np.zeros([R, nA])
+    target = np.clip(f(zero), 1 - eps, 1 + eps)
+    feasible = ((target >= (c*lo).sum(1) - 1e-10) & (target <= (c*hi).sum(1) + 1e-10)).all(1)
+    pos = c > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lam_lo = np.where(pos, (lo - gt)/c, np.inf).min(-1)
+        lam_hi = np.where(pos, (hi - gt)/c, -np.inf).max(-1)
+    lam_lo = np.minimum(lam_lo, 0); lam_hi = np.maximum(lam_hi, 0)
+    for it in range(100):
+        mid = (lam_lo + lam_hi) / 2
+        below = f(mid) < target
+        lam_lo = np.where(below, mid, lam_lo); lam_hi = np.where(below, lam_hi, mid)
+    # exact multiplier on the active set at the bracket midpoint
+    mid = (lam_lo + lam_hi) / 2
+    x = gt + mid[...,None]*c
+    free = pos & (x > lo) & (x < hi)
+    clipped = np.clip(x, lo, hi)
+    cc = (np.where(free, c*c, 0)).sum(-1)
+    rhs = target - np.where(free, 0, c*clipped).sum(-1) - np.where(free, c*gt, 0).sum(-1)
+    lam = np.where(cc > 0, rhs / np.where(cc > 0, cc, 1), mid)
+    lam = np.clip(lam, lam_lo, lam_hi)
+    # keep the exact solution only where it stays on the same active set
+    lam = np.where(np.abs(f(lam) - target) <= np.abs(f(mid) - target), lam, mid)
+    g_ = np.clip(gt + lam[...,None]*c, lo, hi)
+    obj = ((g_ - gt)**2).sum(axis=(1,2))
+    return [g_.reshape([R, nA, nS, -1]).transpose(0,2,1,3), obj, feasible]
+
+#@jit
+def proj_g_gurobi(g_tilde, *args): 
+    ''' Project a given g vector onto feasible vector with a Gurobi QP
     '''
     data = args[0] 
     a_bnd = data['a_bnd']; b_bnd = data['b_bnd']
@@ -436,6 +699,7 @@ def proj_g_(g_tilde, *args):
     nA = len(p_e_s)
     s_a_giv_sprime = data['s_a_giv_sprime'] 
     tight = data['tight']
+    epsilon = data.get('epsilon', 0)
 
     m = gp.Model()
     g = m.addVars(nS,nA,nS) 
@@ -966,35 +1230,14 @@ def proj_grad_descent_smoothed(g, N_RNDS, data,
 def grad_H_wrt_g_explicit(g, *args): 
     ''' Evaluate gradient
     Assume g is [k,a,j]
-     -({I}[j /= |S|]  pi^e_a,j Pb_{j,a,k}) (\E[A']^{-\top } \Phi \theta^\top)_{i,j}
+     -({I}[k /= |S|]  pi^e_a,j Pb_{j,a,k}) (\E[A']^{-\top } \Phi \theta^\top)_{k,j}
     '''
     data = args[0]
     Phi = data['Phi'] # state
-    p_infty_b_s = data['pbs'] 
-    nSmarg = len(p_infty_b_s)
-    s_a_giv_sprime = data['s_a_giv_sprime'] 
-    p_e_s = data['p_e_s'];     nA = len(p_e_s); check_grad = data['check_grad']
-    A = np.zeros([nSmarg,nSmarg])
-    for k in range(nSmarg): 
-        for j in range(nSmarg): 
-            A[k,j] += sum( [ s_a_giv_sprime[j,a,k]*p_infty_b_s[k] * (p_e_s[a,j] *g[k,a,j] ) for a in range(nA)] )
-        A[k,k] -= p_infty_b_s[k]
-    tildeA = A
-    # Make regular and add normalization 
-    tildeA[-1,:] = p_infty_b_s
-    v = np.zeros([nSmarg]); v[-1] = 1 
-    theta = np.linalg.inv(tildeA).dot(v)
-    # print 'theta from grad comp,', theta
-    # gradient specific operations 
-    outer_ = np.outer(Phi, theta)
-    M = np.linalg.inv(tildeA).dot(outer_)
-    g_grad = np.zeros(g.shape)
-    s_a_giv_sprime = data['s_a_giv_sprime'] ;p_e_s = data['p_e_s'];    p_infty_b_s = data['pbs'] 
-    for k in range(g_grad.shape[0]): 
-        for a in range(g_grad.shape[1]): 
-            for j in range(g_grad.shape[2])[:-1]: # omit last row of J  
-                g_grad[k,a,j] = -1*M[j,k]*s_a_giv_sprime[j,a,k]*p_infty_b_s[k]*p_e_s[a,j]
-                # j,k or k,j ? 
+    coefs = obj_coefs(data)
+    lu = lu_factor(obj_A(g, data, coefs))
+    theta = obj_theta(lu)
+    g_grad = obj_grad(lu, theta, Phi, coefs)
     return [g_grad,theta]
 
 #@jit
@@ -1178,6 +1421,74 @@ def opt_w_restarts_parallel(N_RST, N_RNDS, data_, g0,
         # ls[j] = losses[best_so_far]
         # ths[j] = THTS[best_so_far]; best_gs[j] = gs_proj[best_so_far]
 
+# theta and the adjoint A^{-T} Phi for a stack of A's; rows that are singular
+# or not finite are flagged in ok
+def solve_batch(A, Phi):
+    R = len(A); nS = A.shape[-1]
+    v = np.zeros([R, nS, 1]); v[:, -1] = 1
+    thetas = np.full([R, nS], np.nan); lams = np.full([R, nS], np.nan)
+    try:
+        thetas = np.linalg.solve(A, v)[..., 0]
+        lams = np.linalg.solve(A.transpose(0,2,1), np.broadcast_to(Phi[:,None], [R, nS, 1]))[..., 0]
+    except np.linalg.LinAlgError:
+        for r in range(R):
+            try:
+                thetas[r] = np.linalg.solve(A[r], v[r, :, 0])
+                lams[r] = np.linalg.solve(A[r].T, Phi)
+            except np.linalg.LinAlgError:
+                pass
+    ok = np.isfinite(thetas).all(1) & np.isfinite(lams).all(1)
+    return [thetas, lams, ok]
+
+#@jit
+def opt_w_restarts_batch(N_RST, N_RNDS, data_, g0, 
+    eta_0=0.5, step_schedule=0.5, max_loss=np.inf, gs_init=None):
+    ''' Projected gradient ascent of Phi theta(g) over N_RST restarts, stored as
+    one R by nS by nA by nS array and advanced in lockstep: A is assembled for
+    all restarts by one einsum, theta and the adjoint come from np.linalg.solve
+    on the stacked matrices and the step is projected with proj_g_batch.
+    Restarts that become infeasible, singular or exceed max_loss are dropped
+    and keep the best iterate they reached. g0 (if given) is restart 0, gs_init
+    overrides the random initializations.
+    Returns [theta, loss, g] of the best restart like opt_w_restarts, or
+    [None, None, None] if no restart is feasible.
+    '''
+    # default is maximization 
+    a_bnd = data_['a_bnd']; b_bnd = data_['b_bnd']
+    Phi = np.asarray(data_['Phi'], dtype=float)
+    nS = len(data_['pbs'])
+    coefs = obj_coefs(data_)
+    if gs_init is None:
+        gs_init = random_gs(a_bnd, b_bnd, N_RST)
+    gs = np.array(gs_init, dtype=float)
+    if g0 is not None: # if handed an initial iterate: include as one of the restarts
+        gs[0] = g0
+    [gs, alive] = proj_g_batch(gs, data_)
+    best_ls = np.full(len(gs), -np.inf); best_ths = np.zeros([len(gs), nS]); best_gs = gs.copy()
+    for k in range(N_RNDS):
+        idx = np.where(alive)[0]
+        if len(idx) == 0:
+            break
+        eta_t = eta_0 * 1.0 / np.power((k + 1) * 1.0, step_schedule)
+        g = gs[idx]
+        [thetas, lams, ok] = solve_batch(obj_A(g, data_, coefs), Phi)
+        losses = thetas.dot(Phi)
+        ok &= losses <= max_loss
+        alive[idx[~ok]] = False
+        idx = idx[ok]; g = g[ok]; thetas = thetas[ok]; lams = lams[ok]; losses = losses[ok]
+        # best so far per restart, not last
+        better = losses > best_ls[idx]
+        best_ls[idx[better]] = losses[better]; best_ths[idx[better]] = thetas[better]
+        best_gs[idx[better]] = g[better]
+        g_step = g + eta_t * obj_grad_adjoint(lams, thetas, coefs)
+        [g_proj, feas] = proj_g_batch(g_step, data_)
+        gs[idx[feas]] = g_proj[feas]
+        alive[idx[~feas]] = False
+    if not np.isfinite(best_ls).any():
+        return [None, None, None]
+    j = np.argmax(best_ls)
+    return [best_ths[j], best_ls[j], best_gs[j]] # return best of restarts
+
 #@jit
 def get_bounds_pgd(logGams,N_RST,N_RNDS, p_a1_s, *args):
     # Get bounds for all gamma parameter values
@@ -1256,6 +1567,45 @@ def get_bounds_pgd_parallel(logGams,N_RST,N_RNDS, p_a1_s, *args):
         min_pgd_bnds[ind] = ls; w_min_pgd_bnds[ind] = th; 
     return [ w_min_pgd_bnds, w_max_pgd_bnds ]
 
+#@jit
+def get_bounds_pgd_continuation(logGams,N_RST,N_RNDS, p_a1_s, *args, N_RST_warm=None, 
+    eta_0=0.5, step_schedule=0.5):
+    ''' Bounds for all gamma values by continuation: walk the sorted logGams and
+    warm start each (min, max) solve of opt_w_restarts_batch from the previous
+    solution, projected into the new box, plus N_RST_warm fresh restarts
+    (default N_RST // 4); the first grid point, or one following an infeasible
+    point, uses all N_RST. The boxes [a_bnd, b_bnd] are nested in gamma, so
+    the previous solution stays feasible and is carried forward whenever it
+    is better, making the bound curve monotone.
+    Returns [w_min_pgd_bnds, w_max_pgd_bnds] in the order of logGams.
+    '''
+    data_ = deepcopy(args[0])
+    ngams = len(logGams)
+    if N_RST_warm is None:
+        N_RST_warm = max(N_RST // 4, 1)
+    w_min_pgd_bnds = [None] * ngams; w_max_pgd_bnds = [None] * ngams
+    Phi = data_['Phi']
+    # per sense: Phi for the upper bound, -Phi for the lower one
+    prev = {1: None, -1: None}
+    prev_bnds = None
+    for ind in np.argsort(logGams): 
+        [a_bnd, b_bnd] = get_bnds_as( p_a1_s, logGams[ind] ); data_['a_bnd']=a_bnd; data_['b_bnd']=b_bnd
+        nested = prev_bnds is not None and (a_bnd <= prev_bnds[0]).all() and (b_bnd >= prev_bnds[1]).all()
+        for sense in (1, -1): 
+            data_['Phi'] = sense * Phi
+            g0 = None if prev[sense] is None else prev[sense][2]
+            n_rst = N_RST if g0 is None else N_RST_warm + 1
+            [th, ls, g] = opt_w_restarts_batch(n_rst, N_RNDS, data_, g0, eta_0=eta_0, step_schedule=step_schedule)
+            if nested and prev[sense] is not None and (ls is None or ls < prev[sense][1]): 
+                [th, ls, g] = prev[sense]
+            prev[sense] = None if ls is None else [th, ls, g]
+            if sense == 1: 
+                w_max_pgd_bnds[ind] = th
+            else: 
+                w_min_pgd_bnds[ind] = th
+        prev_bnds = [a_bnd, b_bnd]
+    return [ w_min_pgd_bnds, w_max_pgd_bnds ]
+
 #@jit
 def primal_opt_outer_L1_(gamma, phi, a_bnd,b_bnd, s_a_giv_sprime, p_infty_b, pe_s, p_a1_s,
                        nS, nA, tight= True, sense_min = True, quiet = True):
@@ -1439,6 +1789,138 @@ def primal_opt_outer_L1_test_function_joint_distn(gamma, phi, a_bnd,b_bnd, joint
     else: 
         return [None, None, None]
 
+class BoundModel(object):
+    ''' Persistent Gurobi model of the outer L1 bound over (g, w, z), built once
+    per (nS, nA, tight) structure with the matrix API (addMVar, sparse
+    constraint matrices, one w^T Q_k g bilinear term per state).
+    joint=True is primal_opt_outer_L1_test_function_joint_distn (joint
+    P(s,a,s'), normalization per (k, a)); joint=False is primal_opt_outer_L1_
+    (P(s,a | s'), normalization per action).
+    set_data swaps the data dependent constraints only when the data changes,
+    set_bnds only changes the bounds of g and solve(sense_min) only the
+    objective sense, starting from the previous solution of that sense.
+    '''
+    def __init__(self, nS, nA, tight=True, joint=True, quiet=True):
+        self.nS = nS; self.nA = nA; self.tight = tight; self.joint = joint
+        m = gp.Model()
+        if quiet: m.setParam("OutputFlag", 0)
+        m.params.NonConvex = 2
+        # g[k,a,j] is entry (k*nA + a)*nS + j
+        self.g = m.addMVar(nS*nA*nS)
+        self.z = m.addMVar(nS)
+        self.w = m.addMVar(nS)
+        self.vars = [self.g, self.z, self.w]
+        m.addConstr(self.z.sum() == 0)
+        m.addConstr(self.w.sum() >= 0.1)
+        if joint and not tight:
+            self.eps = m.addMVar(nS*nA)
+            self.vars.append(self.eps)
+            m.addConstr(self.eps.sum() <= 0.05)
+        if not joint:
+            m.addConstr(self.w.sum() == 1)
+        self.m = m
+        self.data = None; self.data_constrs = []; self.starts = {}
+
+    def set_data(self, phi, P_sas, p_infty_b, pe_s):
+        data = [np.asarray(phi, dtype=float).flatten(), np.asarray(P_sas, dtype=float),
+                np.asarray(p_infty_b, dtype=float).flatten(), np.asarray(pe_s, dtype=float)]
+        if self.data is not None and all(np.array_equal(x, y) for x, y in zip(data, self.data)):
+            return
+        [phi, P_sas, p_infty_b, pe_s] = data
+        nS = self.nS; nA = self.nA; m = self.m; g = self.g; w = self.w
+        for c in self.data_constrs:
+            m.remove(c)
+        constrs = []
+        # |-w_k p_b(k) + sum_{j,a} w_j P[j,a,k] pi_e(a|j) g[k,a,j]| <= z_k
+        # (without p_b(k) for P(s,a | s'))
+        coef = P_sas * pe_s.T[:,:,None]
+        lin = p_infty_b if self.joint else np.ones(nS)
+        [jj, aa] = np.meshgrid(np.arange(nS), np.arange(nA), indexing='ij')
+        wl = w.tolist(); zl = self.z.tolist()
+        for k in range(nS):
+            Q = csr_matrix((coef[:,:,k].ravel(), (jj.ravel(), ((k*nA + aa)*nS + jj).ravel())),
+                           shape=(nS, nS*nA*nS))
+            constrs.append(m.addMQConstr(Q, np.array([-lin[k], -1.]), '<', 0, w, g, [wl[k], zl[k]]))
+            constrs.append(m.addMQConstr(-Q, np.array([lin[k], -1.]), '<', 0, w, g, [wl[k], zl[k]]))
+        # normalization of g, rows (k, a) or a
+        cols = np.arange(nS*nA*nS)
+        if self.joint:
+            M = csr_matrix((P_sas.transpose(2,1,0).ravel(), (cols // nS, cols)), shape=(nS*nA, nS*nA*nS))
+            # p^infty(k | a)
+            rhs = (P_sas.sum(axis=0) / P_sas.sum(axis=(0,2))[:,None]).T.ravel()
+            if self.tight:
+                constrs.append(m.addConstr(M @ g == rhs))
+            else:
+                constrs.append(m.addConstr(M @ g - self.eps <= rhs))
+                constrs.append(m.addConstr(M @ g + self.eps >= rhs))
+            constrs.append(m.addConstr(p_infty_b @ w == 1))
+            obj = phi * p_infty_b
+        else:
+            vals = (P_sas.transpose(2,1,0) * p_infty_b[:,None,None]).ravel()
+            M = csr_matrix((vals, ((cols // nS) % nA, cols)), shape=(nA, nS*nA*nS))
+            if self.tight:
+                constrs.append(m.addConstr(M @ g == 1))
+            else:
+                epsilon = 0.1
+                constrs.append(m.addConstr(M @ g <= 1 + epsilon))
+                constrs.append(m.addConstr(M @ g >= 1 - epsilon))
+            obj = phi
+        m.setObjective(obj @ w)
+        self.data = data; self.data_constrs = constrs; self.starts = {}
+
+    def set_bnds(self, a_bnd, b_bnd):
+        # g also keeps the default lower bound 0 of the original models
+        self.g.lb = np.tile(np.maximum(a_bnd, 0).ravel(), self.nS)
+        self.g.ub = np.tile(np.asarray(b_bnd).ravel(), self.nS)
+
+    def solve(self, sense_min=True):
+        m = self.m
+        m.ModelSense = gp.GRB.MINIMIZE if sense_min else gp.GRB.MAXIMIZE
+        start = self.starts.get(sense_min)
+        for i, v in enumerate(self.vars):
+            v.Start = gp.GRB.UNDEFINED if start is None else start[i]
+        m.optimize()
+        if (m.status == gp.GRB.OPTIMAL): 
+            self.starts[sense_min] = [v.X for v in self.vars]
+            return [m.objVal, self.w.X.tolist(), m]
+        else: 
+            return [None, None, None]
+
+_bound_models = {}
+
+def get_bound_model(nS, nA, tight=True, joint=True, quiet=True):
+    key = (nS, nA, tight, joint, quiet)
+    if key not in _bound_models:
+        _bound_models[key] = BoundModel(nS, nA, tight, joint, quiet)
+    return _bound_models[key]
+
+#@jit
+def primal_opt_outer_L1_cached(gamma, phi, a_bnd,b_bnd, s_a_giv_sprime, p_infty_b, pe_s, p_a1_s,
+                       nS, nA, tight= True, sense_min = True, quiet = True):
+    '''
+    primal_opt_outer_L1_ on a persistent model from get_bound_model
+    '''
+    for k in range(nS): 
+        assert np.isclose((s_a_giv_sprime[:,:,k].sum()), 1,atol = 0.01)
+    assert np.isclose(sum(p_infty_b), 1)
+    bm = get_bound_model(nS, nA, tight, False, quiet)
+    bm.set_data(phi, s_a_giv_sprime, p_infty_b, pe_s)
+    bm.set_bnds(a_bnd, b_bnd)
+    return bm.solve(sense_min)
+
+#@jit
+def primal_opt_outer_L1_test_function_joint_distn_cached(gamma, phi, a_bnd,b_bnd, joint_s_a_sprime, p_infty_b, pe_s, 
+                       nS, nA, tight= True, sense_min = True, quiet = True):
+    '''
+    primal_opt_outer_L1_test_function_joint_distn on a persistent model from
+    get_bound_model
+    '''
+    assert np.isclose((joint_s_a_sprime.sum()), 1,atol = 0.01)
+    bm = get_bound_model(nS, nA, tight, True, quiet)
+    bm.set_data(phi, joint_s_a_sprime, p_infty_b, pe_s)
+    bm.set_bnds(a_bnd, b_bnd)
+    return bm.solve(sense_min)
+
 #@jit
 def plot_bounds(w_min_pgd_bnds, w_max_pgd_bnds, Phi, ngams, nSmarg, logGams,rearrange=True, label = '', color = 'b'): 
 # preprocess to remove none values
@@ -2216,10 +2698,10 @@ def generate_data_get_bounds(phi, nns, nS, nA, nU, nSmarg, P, Pi, state_dist, n,
 
         for ind,logGam in enumerate(logGams_full):
             sense_min = False; [a_bnd, b_bnd] = get_bnds_as( p_a1_s, logGam )
-            [objVal, w_, m] = primal_opt_outer_L1_test_function_joint_distn(None, phi, a_bnd,b_bnd, joint_s_a_sprime_agg, p_infty_b_s, p_e_s, nSmarg, nA, tight, sense_min, quiet)
+            [objVal, w_, m] = primal_opt_outer_L1_test_function_joint_distn_cached(None, phi, a_bnd,b_bnd, joint_s_a_sprime_agg, p_infty_b_s, p_e_s, nSmarg, nA, tight, sense_min, quiet)
             min_bnds[ind_n][ind] = objVal#; w_min_bnds[ind] = w_;
             sense_min = True
-            [objVal, w_, m] = primal_opt_outer_L1_test_function_joint_distn(None, phi, a_bnd,b_bnd, joint_s_a_sprime_agg, p_infty_b_s, p_e_s, nSmarg, nA, tight, sense_min, quiet)
+            [objVal, w_, m] = primal_opt_outer_L1_test_function_joint_distn_cached(None, phi, a_bnd,b_bnd, joint_s_a_sprime_agg, p_infty_b_s, p_e_s, nSmarg, nA, tight, sense_min, quiet)
             max_bnds[ind_n][ind] = objVal#; w_max_bnds[ind] = w_;
     pickle.dump([min_bnds, max_bnds, nns, logGams_full], open('output-log'+datetime.now().strftime('%Y-%m-%d-%H-%M-%S')+'.p','wb') )
     return [min_bnds, max_bnds]
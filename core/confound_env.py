@@ -1,6 +1,7 @@
 #Code from David Bruns-Smith, Model-Free and Model-Based Policy Evaluation when Causality is Uncertain
 
 import numpy as np
+import tensor_bellman
 
 #------------------------------------------------------------------------
 # Helper functions to make confounded versions
@@ -45,28 +46,8 @@ def rand_pi_val(tx, R, x_dist, horizon):
     for i in range(nStates):
         rand_pi[i,:] = [1/nActions for a in range(nActions)]
     gamma = 0.98
-    
-    def bellman_eval_update(f, pi):
-        Tf = np.zeros(f.shape)
-        for s in range(nStates):
-            for a in range(nActions):
-                f_pi = np.array([pi[xp] @ f[xp, :] for xp in range(nStates)])
-                Tf[s,a] = tx[a, s] @ (R[a, s] + gamma * f_pi) 
-        return Tf
-    
-    def bellman_eval(pi, horizon):
-        Q = np.zeros((nStates, nActions))
-        for k in range(horizon):
-            Q = bellman_eval_update(Q, pi)
-        return Q
-    
-    def get_value(Q, pi):
-        V = np.array([Q[x] @ pi[x] for x in range(nStates)])
-        avgV = V @ x_dist
-        return V, avgV
-    
-    Q = bellman_eval(rand_pi, horizon)
-    V, _ = get_value(Q, rand_pi)
+    Q = tensor_bellman.finite_horizon_eval(rand_pi, tx[None], R, gamma, np.ones(1), horizon)
+    V, _ = tensor_bellman.policy_value(Q, rand_pi, x_dist)
     return V
 
 def confound_V(tx, x_dist, V, confound_weight=0.1):
@@ -1,6 +1,7 @@
 #Code from David Bruns-Smith, Model-Free and Model-Based Policy Evaluation when Causality is Uncertain
 
 import numpy as np
+import tensor_bellman
 
 class ConfoundMDP(object):
     def __init__(self, P, R, x_dist, u_dist, gamma):
@@ -46,33 +47,13 @@ class ConfoundMDP(object):
         return np.array(traj)
 
     def bellman_eval_update(self, f, pi):
-        R = self.R
-        P = self.P
-        nStates = self.n_states
-        nActions = self.n_actions
-        nU = self.n_confound
-        gamma = self.gamma
-        Tf = np.zeros(f.shape)
-        for s in range(nStates):
-            for a in range(nActions):
-                f_pi_avg = 0
-                for u in range(nU):
-                    f_pi_u = np.array([pi[u, xp] @ f[xp, :] for xp in range(nStates)])
-                    f_pi_avg += f_pi_u * self.u_dist[u]
-                for u in range(nU):
-                    Tf[s,a] += P[u, a, s] @ (R[a, s] + gamma * f_pi_avg) * self.u_dist[u]
-        return Tf
+        return tensor_bellman.bellman_update(f, pi, self.P, self.R, self.gamma, self.u_dist)
 
     def bellman_eval(self, pi, horizon):
-        Q = np.zeros((self.n_states, self.n_actions))
-        for k in range(horizon):
-            Q = self.bellman_eval_update(Q, pi)
-        return Q
+        return tensor_bellman.finite_horizon_eval(pi, self.P, self.R, self.gamma, self.u_dist, horizon)
 
     def get_value(self, Q, pi):
-        V = np.array([Q[x] @ pi[x] for x in range(self.n_states)])
-        avgV = V @ self.x_dist
-        return V, avgV
+        return tensor_bellman.policy_value(Q, pi, self.x_dist)
 
     def generate_persist_trajectory(self, pi_b, horizon):
         self.reset()
@@ -86,6 +67,44 @@ class ConfoundMDP(object):
             traj.append([x,a,u,xp,r])
         return np.array(traj)
 
+    def generate_trajectory_batch(self, pi_b, horizon, nsamples, iid=True, rng=None, out=None):
+        # Advance nsamples trajectories in lockstep with inverse-CDF lookups
+        # into cumulative tables over P[u,a,x] and pi_b[u,x].
+        # Same x, a, u, x', r layout as generate_trajectory; iid=False gives
+        # the persistent confounder of generate_persist_trajectory.
+        if rng is None:
+            rng = np.random.default_rng()
+        if out is None:
+            out = np.empty((nsamples, horizon, 5))
+        nS, nA, nU = self.n_states, self.n_actions, self.n_confound
+        P_cdf = self._transition_cdf()
+        pi_cdf = cdf_table(np.asarray(pi_b).reshape(nU*nS, nA))
+        x_cdf = cdf_table(np.asarray(self.x_dist)[None])
+        u_cdf = cdf_table(np.asarray(self.u_dist)[None])
+
+        zeros = np.zeros(nsamples, dtype=np.int64)
+        x = sample_cdf(x_cdf, nS, zeros, rng.random(nsamples))
+        u = sample_cdf(u_cdf, nU, zeros, rng.random(nsamples))
+        for t in range(horizon):
+            if iid and t > 0:
+                u = sample_cdf(u_cdf, nU, zeros, rng.random(nsamples))
+            a = sample_cdf(pi_cdf, nA, u*nS + x, rng.random(nsamples))
+            xp = sample_cdf(P_cdf, nS, (u*nA + a)*nS + x, rng.random(nsamples))
+            out[:, t, 0] = x
+            out[:, t, 1] = a
+            out[:, t, 2] = u
+            out[:, t, 3] = xp
+            out[:, t, 4] = self.R[a, x, xp]
+            x = xp
+        return out
+
+    def _transition_cdf(self):
+        # cached, rebuilt if P is swapped out
+        if getattr(self, '_P_cdf_src', None) is not self.P:
+            self._P_cdf = cdf_table(np.asarray(self.P).reshape(-1, self.n_states))
+            self._P_cdf_src = self.P
+        return self._P_cdf
+
 """     def bellman_eval_update_u(self, f, pi):
         R = self.R
         P = self.P
@@ -125,6 +144,25 @@ def collect_persist_sample(nsamples, mdp, pi_b, horizon):
     # x, a, u, x', r
     return dataset
 
+# Flattened cumulative table for vectorized inverse-CDF sampling. Row i is
+# offset by i so one searchsorted call serves a different row per draw.
+def cdf_table(probs):
+    cdf = np.cumsum(probs, axis=1)
+    total = cdf[:, -1:]
+    cdf = np.divide(cdf, total, out=cdf, where=total > 0)
+    return (cdf + np.arange(len(cdf))[:, None]).ravel()
+
+def sample_cdf(table, nCols, rows, rand):
+    idx = np.searchsorted(table, rows + rand, side='right') - rows * nCols
+    return np.clip(idx, 0, nCols - 1)
+
+def collect_sample_batch(nsamples, mdp, pi_b, horizon, iid=True, rng=None):
+    # x, a, u, x', r
+    return mdp.generate_trajectory_batch(pi_b, horizon, nsamples, iid, rng)
+
+def collect_persist_sample_batch(nsamples, mdp, pi_b, horizon, rng=None):
+    return mdp.generate_trajectory_batch(pi_b, horizon, nsamples, False, rng)
+
 def calc_returns(data, gamma, horizon):
     rewards = data[:,:,-1]
     g = np.array([gamma**t for t in range(horizon)])
@@ -1,6 +1,8 @@
 #Code from David Bruns-Smith, Model-Free and Model-Based Policy Evaluation when Causality is Uncertain
 
 import confound_mdp
+import tensor_bellman
+import suffstats
 import numpy as np
 from tqdm import tqdm
 
@@ -41,23 +43,28 @@ def WIS(dataset, gamma, horizon, pihat, pi_e):
 #   FQE and helper functions
 #------------------------------------------------------------------------------------
 
+# (s,a) counts plus weighted reward sums and (s,a,s') transition counts, computed
+# once per dataset so each FQE backup is a contraction independent of sample size
+def fqe_statistics(dataset, nStates, nActions, weights=None, sparse=False):
+    N_sa = suffstats.get_stats(dataset, nStates, nActions, sparse=sparse)['N_sa']
+    stats = suffstats.get_stats(dataset, nStates, nActions, weights=weights, sparse=sparse)
+    return [N_sa, stats['R_sa'], stats['N_sas']]
+
+def fqe_update(f, pi_e, stats, gamma):
+    N_sa, R_sa, N_sas = stats
+    v = (pi_e * f).sum(1)
+    Tf_hat = R_sa + gamma * (N_sas @ v).reshape(N_sa.shape)
+    return np.divide(Tf_hat, N_sa, out=np.zeros(N_sa.shape), where=N_sa > 0)
+
 def fitted_q_update(f, pi_e, dataset, mdp):
-    nStates = mdp.n_states
-    nActions = mdp.n_actions
-    data = dataset.reshape((dataset.shape[0]*dataset.shape[1],5))
-    regression_data = np.array([[x, a, r + mdp.gamma * (pi_e[int(xp)] @ f[int(xp),:])] for x,a,u,xp,r in data])
-    Tf_hat = np.zeros((nStates, nActions))
-    for x,a,y in regression_data:
-        Tf_hat[int(x), int(a)] += y
-    idx, count = np.unique(data[:,:2], axis=0, return_counts=True)
-    for i,[x,a] in enumerate(idx):
-        Tf_hat[int(x),int(a)] /= count[i]
-    return Tf_hat
+    stats = fqe_statistics(dataset, mdp.n_states, mdp.n_actions)
+    return fqe_update(f, pi_e, stats, mdp.gamma)
 
-def fitted_q_evaluation(pi_e, dataset, horizon, mdp):
+def fitted_q_evaluation(pi_e, dataset, horizon, mdp, sparse=False):
+    stats = fqe_statistics(dataset, mdp.n_states, mdp.n_actions, sparse=sparse)
     Qhat = np.zeros((mdp.n_states, mdp.n_actions))
     for k in tqdm(range(horizon)):
-        newQ = fitted_q_update(Qhat, pi_e, dataset, mdp)
+        newQ = fqe_update(Qhat, pi_e, stats, mdp.gamma)
         #trueNewQ = bellman_eval_update(Qhat, np.array([pi_e,pi_e]))
         #print("Squared error: " + str(((newQ - trueNewQ)**2).sum()))
         Qhat = newQ
@@ -66,17 +73,8 @@ def fitted_q_evaluation(pi_e, dataset, horizon, mdp):
 
 # compute empirical frequency of u given a state and an action 
 def calc_u_prob(dataset, mdp):
-    nStates = mdp.n_states
-    nActions = mdp.n_actions
-    u_hit = np.zeros((nStates, nActions))
-    counts = np.zeros((nStates, nActions))
-
-    for traj in dataset:
-        for x,a,u,xp,r in traj:
-            u_hit[int(x), int(a)] += u
-            counts[int(x), int(a)] += 1
-
-    u_prob = u_hit/counts
+    stats = suffstats.get_stats(dataset, mdp.n_states, mdp.n_actions)
+    u_prob = suffstats.safe_divide(stats['U_sa'], stats['N_sa'], fill=np.nan)
     #xa_prob = counts / (counts.sum())
     return u_prob
 
@@ -98,44 +96,20 @@ def bellman_eval_update_biased(f, pi_b, pi, mdp):
     P = mdp.P
     R = mdp.R
     gamma = mdp.gamma
-    nStates = mdp.n_states
-    nActions = mdp.n_actions
     u_prob = u_cond_x_a(pi_b, mdp)
-
-    Tf = np.zeros(f.shape)
-    for s in range(nStates):
-        for a in range(nActions):
-            f_pi_0 = np.array([pi[0, xp] @ f[xp, :] for xp in range(nStates)])
-            f_pi_1 = np.array([pi[1, xp] @ f[xp, :] for xp in range(nStates)])
-            f_pi_avg = 0.5 * f_pi_0 + 0.5 * f_pi_1
-            u0 = P[0, a, s] @ (R[a, s] + gamma * f_pi_avg)
-            u1 = P[1, a, s] @ (R[a, s] + gamma * f_pi_avg)
-            p_u = u_prob[s,a]
-            Tf[s,a] = (1-p_u) * u0 + p_u * u1
-    return Tf
+    u_weights = np.stack([1 - u_prob, u_prob])
+    return tensor_bellman.bellman_update(f, pi, P, R, gamma, np.array([0.5, 0.5]), u_weights)
 
 def marginal_policy(pi_b, u_dist):
     return pi_b[0] * u_dist[0] + pi_b[1] * u_dist[1]
 
 def reweighted_q_update(f, pi_b, pi_e, dataset, mdp):
-    nStates = mdp.n_states
-    nActions = mdp.n_actions
-
     marg_pi = marginal_policy(pi_b, mdp.u_dist)
-    data = dataset.reshape((dataset.shape[0]*dataset.shape[1],5))
-    y_data = np.array([[x, a, r + mdp.gamma * (pi_e[int(xp)] @ f[int(xp),:])] for x,a,u,xp,r in data])
-    
+    x, a, u = [dataset[...,i].astype(int) for i in range(3)]
     # importance weight style TRUE reweighting term:
-    adjustment_weights = np.array([[1, 1, marg_pi[int(x), int(a)] / pi_b[int(u), int(x), int(a)]] for x,a,u,xp,r in data])
-    regression_data = adjustment_weights * y_data
-    
-    Tf_hat = np.zeros((nStates, nActions))
-    for x,a,y in regression_data:
-        Tf_hat[int(x), int(a)] += y
-    idx, count = np.unique(data[:,:2], axis=0, return_counts=True)
-    for i,[x,a] in enumerate(idx):
-        Tf_hat[int(x),int(a)] /= count[i]
-    return Tf_hat
+    adjustment_weights = marg_pi[x, a] / pi_b[u, x, a]
+    stats = fqe_statistics(dataset, mdp.n_states, mdp.n_actions, weights=adjustment_weights)
+    return fqe_update(f, pi_e, stats, mdp.gamma)
 
 # reweighting when you don't know u:
 def bound_reweighted_update(f, pi_e, dataset, weight_bound, mdp):
@@ -294,50 +268,20 @@ def sorted_reweight_update(f, pi_e, dataset, weight_bound, mdp, verbose=False):
 def estimate_P(dataset, mdp):
     nStates = mdp.n_states
     nActions = mdp.n_actions
-    data = dataset.reshape((dataset.shape[0]*dataset.shape[1],5))
-    
-    Phat = np.zeros((nActions, nStates, nStates))
-    counts = np.zeros((nActions, nStates))
-    for x,a,u,xp,r in data:
-        Phat[int(a), int(x), int(xp)] += 1
-        counts[int(a), int(x)] += 1
-    for a in range(nActions):
-        for x in range(nStates):
-            if counts[a,x] > 0:
-                Phat[a,x] /= counts[a,x]
-    return Phat
+    stats = suffstats.get_stats(dataset, nStates, nActions)
+    counts = suffstats.to_asp(stats['N_sas'], nStates, nActions)
+    return suffstats.safe_divide(counts, counts.sum(-1, keepdims=True))
 
 def estimate_R(dataset, mdp):
     nStates = mdp.n_states
     nActions = mdp.n_actions
-    data = dataset.reshape((dataset.shape[0]*dataset.shape[1],5))
-    
-    Rhat = np.zeros((nActions, nStates, nStates))
-    counts = np.zeros((nActions, nStates, nStates))
-    for x,a,u,xp,r in data:
-        Rhat[int(a), int(x), int(xp)] += r
-        counts[int(a), int(x), int(xp)] += 1
-    for a in range(nActions):
-        for x in range(nStates):
-            for xp in range(nStates):
-                if counts[a,x,xp] > 0:
-                    Rhat[a,x, xp] /= counts[a,x,xp]
-    return Rhat
+    stats = suffstats.get_stats(dataset, nStates, nActions)
+    return suffstats.safe_divide(suffstats.to_asp(stats['R_sas'], nStates, nActions),
+                                 suffstats.to_asp(stats['N_sas'], nStates, nActions))
 
 def estimate_pi(dataset, mdp):
-    nStates = mdp.n_states
-    nActions = mdp.n_actions   
-    data = dataset.reshape((dataset.shape[0]*dataset.shape[1],5))
-    
-    pihat = np.zeros((nActions, nStates))
-    counts = np.zeros(nStates)
-    for x,a,u,xp,r in data:
-        pihat[int(a), int(x)] += 1
-        counts[int(x)] += 1
-    for x in range(nStates):
-        if counts[x] > 0:
-            pihat[:,x] /= counts[x]
-    return pihat.T
+    stats = suffstats.get_stats(dataset, mdp.n_states, mdp.n_actions)
+    return suffstats.safe_divide(stats['N_sa'], stats['N_s'][:, None])
 
 
 def worst_case_ax_norm(action, state, dataset, pi_e, f, x0, P_bound, cond_bound, mdp):
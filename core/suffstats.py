@@ -0,0 +1,87 @@
+#Count / reward sufficient statistics of a dataset of x, a, u, x', r transitions
+#
+# Everything is computed in one pass with np.bincount on flattened indices and
+# shared by the estimators in confound_ope and mcmix/helpers.
+
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import scipy.sparse
+
+_cache = OrderedDict()
+CACHE_SIZE = 4
+
+def clear_cache():
+    _cache.clear()
+
+# key on the dataset contents rather than the object, so that in-place edits
+# (relabeled states, overwritten rewards) miss the cache instead of returning
+# stale counts; hashing is a single pass, well under the cost of the bincounts
+def _cache_key(dataset, *args):
+    data = np.ascontiguousarray(dataset)
+    digest = hashlib.sha1(memoryview(data).cast('B')).digest()
+    return (digest, data.shape, data.dtype.str) + args
+
+# dataset is N by T by 5 (or n by 5), burnin drops the first steps of each
+# trajectory, weights is per transition (N by T) or per trajectory (N,), e.g.
+# soft cluster responsibilities. With sparse=True the (s,a,s') tensors are
+# csr matrices with rows s*nActions + a, otherwise dense arrays of that shape.
+#
+# Returns a dict with
+#   N_s, N_sa          (weighted) visit counts, S and S by A
+#   R_sa, U_sa         reward / confounder sums, S by A
+#   N_sas, R_sas       transition counts / reward sums, S*A by S
+# Unweighted results are memoized by dataset contents (cache=False skips the
+# lookup) and shared between callers, so don't modify them in place.
+def get_stats(dataset, nStates, nActions, burnin=0, weights=None, sparse=False, cache=True):
+    key = None
+    if cache and weights is None:
+        key = _cache_key(dataset, nStates, nActions, burnin, sparse)
+        hit = _cache.get(key)
+        if hit is not None:
+            _cache.move_to_end(key)
+            return hit
+
+    if dataset.ndim == 2:
+        dataset = dataset[None]
+        if weights is not None:
+            weights = weights.reshape((1, -1))
+    data = dataset[:, burnin:]
+    x, a, u, xp = [data[..., i].astype(int).ravel() for i in range(4)]
+    r = data[..., 4].ravel()
+    if weights is None:
+        w = np.ones(len(x))
+    else:
+        w = np.broadcast_to(weights[:, burnin:] if weights.ndim == 2
+                            else weights[:, None], data.shape[:2]).ravel()
+
+    nSA = nStates * nActions
+    sa = x * nActions + a
+    stats = {
+        'N_s': np.bincount(x, weights=w, minlength=nStates),
+        'N_sa': np.bincount(sa, weights=w, minlength=nSA).reshape((nStates, nActions)),
+        'R_sa': np.bincount(sa, weights=w * r, minlength=nSA).reshape((nStates, nActions)),
+        'U_sa': np.bincount(sa, weights=w * u, minlength=nSA).reshape((nStates, nActions)),
+    }
+    if sparse:
+        stats['N_sas'] = scipy.sparse.csr_matrix((w, (sa, xp)), shape=(nSA, nStates))
+        stats['R_sas'] = scipy.sparse.csr_matrix((w * r, (sa, xp)), shape=(nSA, nStates))
+    else:
+        sas = sa * nStates + xp
+        stats['N_sas'] = np.bincount(sas, weights=w, minlength=nSA*nStates).reshape((nSA, nStates))
+        stats['R_sas'] = np.bincount(sas, weights=w * r, minlength=nSA*nStates).reshape((nSA, nStates))
+
+    if key is not None:
+        _cache[key] = stats
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return stats
+
+# S*A by S statistic as a dense A by S by S' array
+def to_asp(N_sas, nStates, nActions):
+    if scipy.sparse.issparse(N_sas):
+        N_sas = N_sas.toarray()
+    return N_sas.reshape((nStates, nActions, nStates)).transpose(1, 0, 2)
+
+def safe_divide(num, den, fill=0):
+    return np.divide(num, den, out=np.full(np.broadcast(num, den).shape, float(fill)), where=den > 0)
@@ -0,0 +1,85 @@
+#Tensorized Bellman evaluation shared by confound_mdp, confound_env and confound_ope
+#
+# P is U by A by S by S, R is A by S by S, pi is U by S by A (or S by A when
+# it does not depend on the confounder), Q is S by A.
+
+import numpy as np
+
+def marginal_P(P, u_dist):
+    return np.einsum('u,uasx->asx', u_dist, P)
+
+def marginal_pi(pi, u_dist):
+    if pi.ndim == 2:
+        return pi
+    return np.einsum('u,uxa->xa', u_dist, pi)
+
+# E[R | s, a] under each confounder, U by S by A
+def expected_reward_u(P, R):
+    return np.einsum('uasx,asx->usa', P, R)
+
+# One Bellman backup. Without u_weights the confounder is averaged with
+# u_dist; u_weights (U by S by A) gives p(u | s, a) per state-action instead.
+def bellman_update(f, pi, P, R, gamma, u_dist, u_weights=None):
+    v = (marginal_pi(pi, u_dist) * f).sum(1)
+    if u_weights is None:
+        Pbar = marginal_P(P, u_dist)
+        return ((Pbar * R).sum(-1) + gamma * Pbar @ v).T
+    Tf_u = expected_reward_u(P, R) + gamma * (P @ v).transpose(0, 2, 1)
+    return (u_weights * Tf_u).sum(0)
+
+def finite_horizon_eval(pi, P, R, gamma, u_dist, horizon, u_weights=None):
+    if u_weights is None:
+        Pbar = marginal_P(P, u_dist)
+        r = (Pbar * R).sum(-1).T
+        P_sa = Pbar.transpose(1, 0, 2)
+    else:
+        r = (u_weights * expected_reward_u(P, R)).sum(0)
+        P_sa = np.einsum('usa,uasx->sax', u_weights, P)
+    pi_m = marginal_pi(pi, u_dist)
+    Q = np.zeros(r.shape)
+    for k in range(horizon):
+        Q = r + gamma * P_sa @ (pi_m * Q).sum(1)
+    return Q
+
+# Fixed point of the discounted operator, (I - gamma P_pi) V = r_pi
+def discounted_eval(pi, P, R, gamma, u_dist):
+    assert gamma < 1, 'discounted_eval needs gamma < 1, use finite_horizon_eval'
+    Pbar = marginal_P(P, u_dist)
+    r = (Pbar * R).sum(-1).T
+    pi_m = marginal_pi(pi, u_dist)
+    P_pi = np.einsum('xa,axy->xy', pi_m, Pbar)
+    V = np.linalg.solve(np.eye(len(P_pi)) - gamma * P_pi, (pi_m * r).sum(1))
+    return r + gamma * (Pbar @ V).T
+
+#------------------------------------------------------------------------
+#   Batched over policies: pis is B by U by S by A or B by S by A
+#------------------------------------------------------------------------
+
+def _batch_marginal_pi(pis, u_dist):
+    if pis.ndim == 3:
+        return pis
+    return np.einsum('u,buxa->bxa', u_dist, pis)
+
+def batch_finite_horizon_eval(pis, P, R, gamma, u_dist, horizon):
+    Pbar = marginal_P(P, u_dist)
+    r = (Pbar * R).sum(-1).T
+    pi_m = _batch_marginal_pi(pis, u_dist)
+    Q = np.zeros(pi_m.shape)
+    for k in range(horizon):
+        v = (pi_m * Q).sum(-1)
+        Q = r + gamma * np.einsum('asx,bx->bsa', Pbar, v)
+    return Q
+
+def batch_discounted_eval(pis, P, R, gamma, u_dist):
+    assert gamma < 1, 'batch_discounted_eval needs gamma < 1, use batch_finite_horizon_eval'
+    Pbar = marginal_P(P, u_dist)
+    r = (Pbar * R).sum(-1).T
+    pi_m = _batch_marginal_pi(pis, u_dist)
+    P_pi = np.einsum('bxa,axy->bxy', pi_m, Pbar)
+    r_pi = (pi_m * r).sum(-1)
+    V = np.linalg.solve(np.eye(P_pi.shape[-1]) - gamma * P_pi, r_pi[..., None])[..., 0]
+    return r + gamma * np.einsum('asx,bx->bsa', Pbar, V)
+
+def policy_value(Q, pi, x_dist):
+    V = (Q * pi).sum(-1)
+    return V, V @ x_dist
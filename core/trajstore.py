@@ -0,0 +1,122 @@
+#Compact integer-encoded trajectories
+#
+# TrajStore keeps m trajectories of length T as integer columns s, a, u, s'
+# (int16 when the indices fit, int32 otherwise) and a float32 reward, in place
+# of dense one-hot (m, T, S, A) / (m, T, S) tensors or (n+1, S) state
+# histories. One-hot arrays are only built on request, for a time window.
+
+import numpy as np
+
+def index_dtype(n):
+    return np.int16 if n <= np.iinfo(np.int16).max else np.int32
+
+class TrajStore(object):
+
+    def __init__(self, s, a, u, sp, r=None, nStates=None, nActions=None):
+        s, a, u, sp = [np.atleast_2d(np.asarray(c)) for c in (s, a, u, sp)]
+        if nStates is None:
+            nStates = int(max(s.max(), sp.max())) + 1
+        if nActions is None:
+            nActions = int(a.max()) + 1
+        self.nStates = nStates
+        self.nActions = nActions
+        self.s = s.astype(index_dtype(nStates))
+        self.sp = sp.astype(index_dtype(nStates))
+        self.a = a.astype(index_dtype(nActions))
+        self.u = u.astype(index_dtype(max(int(u.max()) + 1, 1)))
+        if r is None:
+            r = np.zeros(s.shape)
+        self.r = np.atleast_2d(np.asarray(r)).astype(np.float32)
+
+    # dataset is N by T by 5 (or n by 5) in x, a, u, x', r order
+    @classmethod
+    def from_dataset(cls, dataset, nStates=None, nActions=None):
+        if dataset.ndim == 2:
+            dataset = dataset[None]
+        return cls(*[dataset[..., i].astype(int) for i in range(4)],
+                   r=dataset[..., 4], nStates=nStates, nActions=nActions)
+
+    # a single chain s_0 .. s_n with actions a_0 .. a_{n-1}, as in simulate_rollouts
+    @classmethod
+    def from_state_seq(cls, states, actions, nStates=None, nActions=None):
+        states = np.asarray(states, dtype=int)
+        return cls(states[:-1], actions, np.zeros(len(states) - 1, dtype=int), states[1:],
+                   nStates=nStates, nActions=nActions)
+
+    @property
+    def shape(self):
+        return self.s.shape
+
+    def __len__(self):
+        return self.s.shape[0]
+
+    def nbytes(self):
+        return sum(c.nbytes for c in (self.s, self.a, self.u, self.sp, self.r))
+
+    def to_dataset(self):
+        return np.stack([self.s, self.a, self.u, self.sp, self.r], axis=-1).astype(float)
+
+    def __getitem__(self, idx):
+        # subset of trajectories, basic slices give views
+        return self._new(*[c[idx] for c in (self.s, self.a, self.u, self.sp, self.r)])
+
+    def window(self, t):
+        # time steps t (slice or index array) of every trajectory
+        return self._new(*[c[:, t] for c in (self.s, self.a, self.u, self.sp, self.r)])
+
+    def _new(self, s, a, u, sp, r, nStates=None):
+        out = TrajStore.__new__(TrajStore)
+        out.nStates = self.nStates if nStates is None else nStates
+        out.nActions = self.nActions
+        out.s, out.a, out.u, out.sp, out.r = [np.atleast_2d(c) for c in (s, a, u, sp, r)]
+        return out
+
+    # marginalize a confounder folded into the state index, s = s_marg*nU + u;
+    # the u column then holds s % nU
+    def agg(self, nU):
+        assert self.nStates % nU == 0
+        return self._new(self.s // nU, self.a, (self.s % nU).astype(self.s.dtype),
+                         self.sp // nU, self.r, nStates=self.nStates // nU)
+
+    def sa_idx(self):
+        return self.s.astype(int) * self.nActions + self.a
+
+    # one-hot encodings, as built in the notebooks with np.eye(...)[idx]
+    def onehot_sa(self, t=slice(None), dtype=np.float32):
+        idx = self.sa_idx()[:, t]
+        out = np.zeros(idx.shape + (self.nStates * self.nActions,), dtype=dtype)
+        np.put_along_axis(out, idx[..., None], 1, axis=-1)
+        return out.reshape(idx.shape + (self.nStates, self.nActions))
+
+    def onehot_sp(self, t=slice(None), dtype=np.float32):
+        idx = self.sp[:, t].astype(int)
+        out = np.zeros(idx.shape + (self.nStates,), dtype=dtype)
+        np.put_along_axis(out, idx[..., None], 1, axis=-1)
+        return out
+
+    # n+1 by S one-hot history of trajectory i, as returned by simulate_rollouts
+    def state_hist(self, i=0):
+        states = np.append(self.s[i, :1], self.sp[i]).astype(int)
+        return np.eye(self.nStates)[states]
+
+    #------------------------------------------------------------------------
+    #   Counts
+    #------------------------------------------------------------------------
+
+    # visits of s_0 .. s_T of every trajectory (S,)
+    def state_counts(self):
+        return (np.bincount(self.s[:, 0], minlength=self.nStates) +
+                np.bincount(self.sp.ravel(), minlength=self.nStates)).astype(float)
+
+    # (a, s) counts, A by S
+    def a_s_counts(self):
+        return np.bincount(self.s.astype(int).ravel() * self.nActions + self.a.ravel(),
+                           minlength=self.nStates*self.nActions).reshape(
+                           (self.nStates, self.nActions)).T.astype(float)
+
+    # (s, a, s') counts, S by A by S
+    def s_a_sprime(self):
+        nSA = self.nStates * self.nActions
+        return np.bincount(self.sa_idx().ravel() * self.nStates + self.sp.ravel(),
+                           minlength=nSA*self.nStates).reshape(
+                           (self.nStates, self.nActions, self.nStates)).astype(float)
@@ -2,13 +2,28 @@
 counterfactual
 """
 import numpy as np
+import scipy.sparse as sp
 import mdptoolboxSrc.mdp as mdptools
 import warnings
 import cf.gumbelTools as gt
 from tqdm import tqdm_notebook as tqdm
 
+def to_csr_lists(mat):
+    """to_csr_lists
+
+    :param mat: Array of shape ([n_components x] n_actions x n_states x
+    n_states), or nested lists of (sparse) matrices
+    :returns: (n_components x n_actions) nested lists of csr_matrix
+    """
+    if isinstance(mat, np.ndarray) and mat.ndim == 3:
+        mat = mat[np.newaxis, ...]
+    elif not isinstance(mat, np.ndarray) and sp.issparse(mat[0]):
+        mat = [mat]
+    return [[sp.csr_matrix(m_a) for m_a in m_c] for m_c in mat]
+
 class MatrixMDP(object):
-    def __init__(self, tx_mat, r_mat, p_initial_state=None, p_mixture=None):
+    def __init__(self, tx_mat, r_mat, p_initial_state=None, p_mixture=None,
+            sparse=False):
         """__init__
 
         :param tx_mat:  Transition matrix of shape (n_components x n_actions x
@@ -18,29 +33,43 @@ class MatrixMDP(object):
         :param p_initial_state: Probability over initial states
         :param p_mixture: Probability over "mixture" components, in this case
         diabetes status
+        :param sparse: Store tx_mat / r_mat as (n_components x n_actions)
+        nested lists of csr_matrix; dense arrays or such lists can be passed
         """
-        # QA the size of the inputs
-        assert tx_mat.ndim == 4 or tx_mat.ndim == 3, \
-            "Transition matrix wrong dims ({} != 3 or 4)".format(tx_mat.ndim)
-        assert r_mat.ndim == 4 or r_mat.ndim == 3, \
-            "Reward matrix wrong dims ({} != 3 or 4)".format(tx_mat.ndim)
-        assert r_mat.shape == tx_mat.shape, \
-            "Transition / Reward matricies not the same shape!"
-        assert tx_mat.shape[-1] == tx_mat.shape[-2], \
-            "Last two dims of Tx matrix should be equal to num of states"
-
-        # Get the number of actions and states
-        n_actions = tx_mat.shape[-3]
-        n_states = tx_mat.shape[-2]
-
-        # Get the number of components in the mixture:
-        # If no hidden component, add a dummy so the rest of the interface works
-        if tx_mat.ndim == 3:
-            n_components = 1
-            tx_mat = tx_mat[np.newaxis, ...]
-            r_mat = r_mat[np.newaxis, ...]
+        if sparse:
+            tx_mat = to_csr_lists(tx_mat)
+            r_mat = to_csr_lists(r_mat)
+            assert len(r_mat) == len(tx_mat) and \
+                len(r_mat[0]) == len(tx_mat[0]), \
+                "Transition / Reward matricies not the same shape!"
+            assert tx_mat[0][0].shape[0] == tx_mat[0][0].shape[1], \
+                "Last two dims of Tx matrix should be equal to num of states"
+            n_components = len(tx_mat)
+            n_actions = len(tx_mat[0])
+            n_states = tx_mat[0][0].shape[0]
         else:
-            n_components = tx_mat.shape[0]
+            # QA the size of the inputs
+            assert tx_mat.ndim == 4 or tx_mat.ndim == 3, \
+                "Transition matrix wrong dims ({} != 3 or 4)".format(tx_mat.ndim)
+            assert r_mat.ndim == 4 or r_mat.ndim == 3, \
+                "Reward matrix wrong dims ({} != 3 or 4)".format(tx_mat.ndim)
+            assert r_mat.shape == tx_mat.shape, \
+                "Transition / Reward matricies not the same shape!"
+            assert tx_mat.shape[-1] == tx_mat.shape[-2], \
+                "Last two dims of Tx matrix should be equal to num of states"
+
+            # Get the number of actions and states
+            n_actions = tx_mat.shape[-3]
+            n_states = tx_mat.shape[-2]
+
+            # Get the number of components in the mixture:
+            # If no hidden component, add a dummy so the rest of the interface works
+            if tx_mat.ndim == 3:
+                n_components = 1
+                tx_mat = tx_mat[np.newaxis, ...]
+                r_mat = r_mat[np.newaxis, ...]
+            else:
+                n_components = tx_mat.shape[0]
 
         # Get the prior over initial states
         if p_initial_state is not None:
@@ -66,6 +95,7 @@ class MatrixMDP(object):
         self.r_mat = r_mat
         self.p_initial_state = p_initial_state
         self.p_mixture = p_mixture
+        self.sparse = sparse
 
         self.current_state = None
         self.component = None
@@ -105,16 +135,26 @@ class MatrixMDP(object):
         assert action in range(self.n_actions), "Invalid action!"
         is_term = False
 
-        next_prob = self.tx_mat[
-                self.component, action, self.current_state,
-                :].squeeze()
+        if self.sparse:
+            # Only sample among the stored (nonzero) entries of the row
+            tx = self.tx_mat[self.component][action]
+            row = slice(tx.indptr[self.current_state],
+                        tx.indptr[self.current_state + 1])
+            next_prob = tx.data[row]
+            assert np.isclose(next_prob.sum(), 1), "Probs do not sum to 1!"
+            next_state = tx.indices[row][
+                np.random.choice(len(next_prob), size=1, p=next_prob)[0]]
+        else:
+            next_prob = self.tx_mat[
+                    self.component, action, self.current_state,
+                    :].squeeze()
 
-        assert np.isclose(next_prob.sum(), 1), "Probs do not sum to 1!"
+            assert np.isclose(next_prob.sum(), 1), "Probs do not sum to 1!"
 
-        next_state = np.random.choice(self.n_states, size=1, p=next_prob)[0]
+            next_state = np.random.choice(self.n_states, size=1, p=next_prob)[0]
 
-        reward = self.r_mat[self.component, action,
-                            self.current_state, next_state]
+        reward = self.reward(self.component, action, self.current_state,
+                             next_state)
         self.current_state = next_state
 
         # In this MDP, rewards are only received at the terminal state
@@ -123,6 +163,54 @@ class MatrixMDP(object):
 
         return self.current_state, reward, is_term
 
+    def tx_row(self, component, action, state):
+        """tx_row
+
+        :returns: Dense next-state distribution (n_states,)
+        """
+        if self.sparse:
+            return self.tx_mat[component][action].getrow(state).toarray()[0]
+        return self.tx_mat[component, action, state, :]
+
+    def tx_prob(self, action, state, next_state):
+        """tx_prob
+
+        :returns: Transition probability under each component (n_components,)
+        """
+        if self.sparse:
+            return np.array([self.tx_mat[c][action][state, next_state]
+                             for c in range(self.n_components)])
+        return self.tx_mat[:, action, state, next_state]
+
+    def reward(self, component, action, state, next_state):
+        if self.sparse:
+            return self.r_mat[component][action][state, next_state]
+        return self.r_mat[component, action, state, next_state]
+
+    def marginal_mats(self):
+        """marginal_mats
+
+        Marginalize tx_mat and r_mat over the mixture components
+
+        :returns: Tuple of (tx_mat_obs, r_mat_obs), arrays of shape (n_actions x
+        n_states x n_states) or per-action lists of csr_matrix if sparse
+        """
+        if not self.sparse:
+            r_mat_obs = self.r_mat.T.dot(self.p_mixture).T
+            tx_mat_obs = self.tx_mat.T.dot(self.p_mixture).T
+            return tx_mat_obs, r_mat_obs
+
+        def marginalize(mats):
+            mats_obs = []
+            for a in range(self.n_actions):
+                m_a = mats[0][a] * self.p_mixture[0]
+                for c in range(1, self.n_components):
+                    m_a = m_a + mats[c][a] * self.p_mixture[c]
+                mats_obs.append(sp.csr_matrix(m_a))
+            return mats_obs
+
+        return marginalize(self.tx_mat), marginalize(self.r_mat)
+
     def policyIteration(self, discount=0.9, obs_pol=None, skip_check=False,
             eval_type=1):
         """Calculate the optimal policy for the marginal tx_mat and r_mat,
@@ -136,8 +224,7 @@ class MatrixMDP(object):
 
         """
         # Define the marginalized transition and reward matrix
-        r_mat_obs = self.r_mat.T.dot(self.p_mixture).T
-        tx_mat_obs = self.tx_mat.T.dot(self.p_mixture).T
+        tx_mat_obs, r_mat_obs = self.marginal_mats()
 
         # Run Policy Iteration
         pi = mdptools.PolicyIteration(
@@ -279,9 +366,8 @@ class BatchSampler(object):
 
                     # Interventional probabilities under new action
                     new_interv_probs = \
-                        self.mdp.tx_mat[component,
-                                        cf_action, current_state,
-                                        :].squeeze().tolist()
+                        self.mdp.tx_row(component[0],
+                                        cf_action, current_state).tolist()
 
                     # If observed sequence did not terminate, then infer cf
                     # probabilities;  Otherwise treat this as an interventional
@@ -293,9 +379,8 @@ class BatchSampler(object):
                     else:
                         # Old and new interventional probabilities
                         prev_interv_probs = \
-                            self.mdp.tx_mat[component,
-                                            obs_action, obs_from_states[time_idx],
-                                            :].squeeze().tolist()
+                            self.mdp.tx_row(component[0],
+                                            obs_action, obs_from_states[time_idx]).tolist()
 
                         assert prev_interv_probs[obs_to_states[time_idx]] != 0
 
@@ -307,8 +392,8 @@ class BatchSampler(object):
 
                     next_state = np.random.choice(
                         self.mdp.n_states, size=1, p=cf_probs)[0]
-                    this_reward = self.mdp.r_mat[
-                        component, cf_action, current_state, next_state]
+                    this_reward = self.mdp.reward(
+                        component[0], cf_action, current_state, next_state)
 
                     # Record result
                     result[obs_samp_idx, cf_samp_idx, time_idx] = (
@@ -352,7 +437,8 @@ class BatchSampler(object):
         with np.errstate(divide='ignore'):
             log_p_initial_state = np.log(self.mdp.p_initial_state)
             log_p_mixture = np.log(self.mdp.p_mixture)
-            log_mat = np.log(self.mdp.tx_mat)
+            if not self.mdp.sparse:
+                log_mat = np.log(self.mdp.tx_mat)
 
         for obs_samp_idx in range(n_samps):
 
@@ -371,6 +457,13 @@ class BatchSampler(object):
                 if batch[obs_samp_idx, time_idx, 1] == -1:
                     break
                 # Update likelihood for observed transitions
+                if self.mdp.sparse:
+                    with np.errstate(divide='ignore'):
+                        this_log_posterior += np.log(self.mdp.tx_prob(
+                            batch[obs_samp_idx, time_idx, 1].astype(int),
+                            batch[obs_samp_idx, time_idx, 2].astype(int),
+                            batch[obs_samp_idx, time_idx, 3].astype(int)))
+                    continue
                 this_log_posterior += log_mat[
                     :,  # Across components
                     batch[obs_samp_idx, time_idx, 1].astype(int),  # Action taken
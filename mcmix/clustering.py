@@ -1,7 +1,14 @@
 import numpy as np
-import tensorflow as tf
 from tqdm import tqdm
+import os
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
 import sklearn
+import sklearn.cluster
+import sklearn.metrics
 import matplotlib.pyplot as plt
 plt.style.use('matplotlibrc')
 
@@ -25,29 +32,66 @@ def computeStat(h1, h2, eigvecsa, device='/CPU:0'):
     return statmns
 '''
 
+#projections of hs (2,m,s,a,s') onto the rank K subspaces eigvecsa (s,a,s',K), (2,m,s,a,K)
+def projectH(hs, eigvecsa):
+    return np.einsum('gmsap,sapk->gmsak', hs, eigvecsa)
+
+#Blocked version of computeStat: the m x m output is tiled and, per (s,a),
+#  (x_j - x_i).(y_j - y_i) = x_i.y_i + x_j.y_j - x_i.y_j - y_i.x_j
+#  is computed from Gram matrices, batched over chunks of (s,a) cells.
+#  Tiles run on a thread pool (matmul releases the GIL) and only tiles on or
+#  above the diagonal are computed, the statistic being symmetric.
+#  Memory is O(sa_chunk tile^2); nan projections count as 0. As in the looped
+#  smalldata=False version the statistic is floored at 0.
+def computeStatBlocked(hs, eigvecsa, proj=True, tile=256, sa_chunk=None, n_jobs=None):
+    projs = projectH(hs, eigvecsa) if proj else hs
+    m = projs.shape[1]
+    K = projs.shape[-1]
+    X = np.nan_to_num(projs[0].reshape((m, -1, K)).transpose(1, 0, 2)).astype(np.float64) #(sa, m, K)
+    Y = np.nan_to_num(projs[1].reshape((m, -1, K)).transpose(1, 0, 2)).astype(np.float64)
+    nSA = X.shape[0]
+    d = np.einsum('smk,smk->sm', X, Y)
+    if sa_chunk is None:
+        sa_chunk = max(1, min(nSA, 2**22 // (tile*tile)))
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    statmns = np.zeros((m, m))
+
+    def runTile(tl):
+        I, J = slice(tl[0], tl[0] + tile), slice(tl[1], tl[1] + tile)
+        out = np.zeros((len(range(m)[I]), len(range(m)[J])))
+        for c0 in range(0, nSA, sa_chunk):
+            c = slice(c0, c0 + sa_chunk)
+            stat = (d[c, I, None] + d[c, None, J]
+                    - X[c, I] @ Y[c, J].transpose(0, 2, 1)
+                    - Y[c, I] @ X[c, J].transpose(0, 2, 1)).max(0)
+            out = np.maximum(out, stat)
+        statmns[I, J] = out
+        statmns[J, I] = out.T
+
+    tiles = [(i0, j0) for i0 in range(0, m, tile) for j0 in range(i0, m, tile)]
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        list(executor.map(runTile, tiles))
+    np.fill_diagonal(statmns, 0)
+    return statmns
+
 def computeStat(hs, eigvecsa, numpy=True, smalldata=True, device='/CPU:0', proj=True):
     if numpy:
+        if not smalldata:
+            return computeStatBlocked(hs, eigvecsa, proj=proj)
         if proj:
             projs = (hs[..., None,:] @ eigvecsa[None,...]).squeeze()
         else:
             projs = hs
-        if smalldata:
-            statmns = np.max(
-                        np.nansum(
-                            (projs[0,None,...] - projs[0,:,None,...]) * 
-                            (projs[1,None,...] - projs[1,:,None,...]), 
-                        axis=-1), 
-                    axis=(2,3))
-        else:
-            statmns = np.zeros((projs.shape[1], projs.shape[1]))
-            for s in tqdm(range(projs.shape[2])):
-                for a in range(projs.shape[3]):
-                    newstats = np.nansum((projs[0, None, :, s, a, :] - projs[0, :, None, s, a, :]) * 
-                                (projs[1, None, :, s, a, :] - projs[1, :, None, s, a, :]), -1)
-                    statmns = np.maximum(statmns, 
-                       newstats)
+        statmns = np.max(
+                    np.nansum(
+                        (projs[0,None,...] - projs[0,:,None,...]) * 
+                        (projs[1,None,...] - projs[1,:,None,...]), 
+                    axis=-1), 
+                axis=(2,3))
         return statmns
     else:
+        import tensorflow as tf
         with tf.device(device):
             hs = tf.convert_to_tensor(hs, np.float32)
             eigvecsa = tf.convert_to_tensor(eigvecsa, np.float32)
@@ -77,13 +121,104 @@ def getClusters(statmns, thresh, K, method='kmeans'):
     return sklearn.cluster.spectral_clustering((statmns < thresh).astype(int), n_clusters=K,
                                                          assign_labels='kmeans')
 
+## THRESHOLD SWEEPS
+#Binary affinities (statmns < tau) for a sequence of taus as sparse matrices.
+#  The upper-triangle entries of the (symmetric) statistic are sorted once, so
+#  the affinity for tau is a prefix of the sorted edges; increasing taus only
+#  add the new edges to the previous matrix.
+class ThresholdGraph(object):
+    def __init__(self, statmns):
+        self.m = len(statmns)
+        rows, cols = np.triu_indices(self.m)
+        w = statmns[rows, cols]
+        order = np.argsort(w, kind='stable')
+        self.rows = rows[order].astype(np.int32)
+        self.cols = cols[order].astype(np.int32)
+        self.w = w[order]
+        self.n = 0
+        self.A = scipy.sparse.csr_matrix((self.m, self.m))
+
+    def affinity(self, tau):
+        n = np.searchsorted(self.w, tau, side='left')
+        if n < self.n:
+            self.n = 0
+            self.A = scipy.sparse.csr_matrix((self.m, self.m))
+        r, c = self.rows[self.n:n], self.cols[self.n:n]
+        off = r != c
+        delta = scipy.sparse.csr_matrix((np.ones(len(r) + off.sum()),
+                                         (np.concatenate([r, c[off]]), np.concatenate([c, r[off]]))),
+                                        shape=(self.m, self.m))
+        self.A = self.A + delta
+        self.n = n
+        return self.A
+
+#Spectral clustering of a sparse affinity as in sklearn.cluster.spectral_clustering
+#  (normalized Laplacian embedding, then k-means), solving for the K smallest
+#  eigenvectors with lobpcg started from X0, e.g. the previous tau's solution.
+#  Returns the labels and the eigenvectors.
+def spectralLabels(A, K, X0=None, random_state=None):
+    m = A.shape[0]
+    L, dd = scipy.sparse.csgraph.laplacian(A, normed=True, return_diag=True)
+    # unit diagonal as in sklearn's spectral_embedding, so isolated vertices
+    # get eigenvalue 1 rather than an extra zero eigenvalue
+    L = scipy.sparse.csr_matrix(L) + scipy.sparse.diags(1 - L.diagonal())
+    if m < 5*K + 50:
+        vecs = np.linalg.eigh(L.toarray())[1][:, :K]
+    else:
+        if X0 is None:
+            X0 = np.random.default_rng(random_state).standard_normal((m, K))
+        vecs = scipy.sparse.linalg.lobpcg(L, X0, largest=False, tol=1e-6, maxiter=200)[1]
+    embedding = vecs / np.where(dd > 0, dd, 1)[:, None]
+    signs = np.sign(embedding[np.abs(embedding).argmax(0), np.arange(K)])
+    embedding = embedding * np.where(signs == 0, 1, signs)
+    labels = sklearn.cluster.k_means(embedding, K, random_state=random_state, n_init=10)[1]
+    return labels, vecs
+
+def sweepChunk(statmns, taus, K, warm_start=True, random_state=None):
+    graph = ThresholdGraph(statmns)
+    labs = []
+    X0 = None
+    for tau in taus:
+        lab, vecs = spectralLabels(graph.affinity(tau), K, X0=X0, random_state=random_state)
+        labs.append(lab)
+        if warm_start:
+            X0 = vecs
+    return labs
+
+#cluster labels for every tau (as getClusters), one row per tau. Taus are
+#  processed in increasing order with warm starts; with n_jobs > 1 contiguous
+#  ranges of taus are swept in separate processes
+def thresholdSweep(statmns, taus, K, warm_start=True, n_jobs=1, random_state=None):
+    taus = np.asarray(taus)
+    order = np.argsort(taus, kind='stable')
+    chunks = [c for c in np.array_split(order, n_jobs) if len(c)]
+    if n_jobs == 1:
+        labs = [sweepChunk(statmns, taus[order], K, warm_start, random_state)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(sweepChunk, statmns, taus[c], K, warm_start, random_state)
+                       for c in chunks]
+            labs = [f.result() for f in futures]
+    out = np.zeros((len(taus), len(statmns)), dtype=int)
+    out[order] = np.concatenate(labs)
+    return out
+
+#adjusted Rand index between thresholdSweep and getClusters at every tau,
+#  all ones when the sweep reproduces sklearn. Graphs whose K smallest
+#  eigenvalues are degenerate (more than K components) have no unique
+#  embedding, and getClusters itself varies from run to run there
+def checkSweep(statmns, taus, K, labs=None, n_jobs=1):
+    if labs is None:
+        labs = thresholdSweep(statmns, taus, K, n_jobs=n_jobs)
+    return np.array([sklearn.metrics.adjusted_rand_score(getClusters(statmns, tau, K), lab)
+                     for tau, lab in zip(taus, labs)])
+
 ## DIAGNOSTICS
-def clusterDiagnostics(statmns, K, labels, lo, hi, step, method='kmeans', figsize=(16,9)):
+def clusterDiagnostics(statmns, K, labels, lo, hi, step, method='kmeans', figsize=(16,9), n_jobs=1):
     accs = []
     wts = []
     taus = np.arange(lo, hi, step)
-    for tau in tqdm(taus):
-        clusterlabs = getClusters(statmns, thresh=tau, K=K, method=method)
+    for clusterlabs in thresholdSweep(statmns, taus, K, n_jobs=n_jobs):
         accs.append(max(np.mean(clusterlabs == labels), 
                         np.mean(clusterlabs != labels)))
         wts.append(max(np.mean(clusterlabs==1), np.mean(clusterlabs==0)))
@@ -94,4 +229,3 @@ def clusterDiagnostics(statmns, K, labels, lo, hi, step, method='kmeans', figsiz
     plt.ylabel('Clustering Accuracy')
     plt.title('Accuracy Against Thresholds')
     plt.legend()
-    
\ No newline at end of file
@@ -4,7 +4,10 @@ import multiprocessing
 from itertools import repeat
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import copy
+import scipy.sparse
+from scipy.special import logsumexp
 import helpers
+import suffstats
 
 # Gets starting state probabilities per mixture component
 def getStartWeights(states, predlabs, K, nStates, hard=True):
@@ -146,35 +149,67 @@ def classify(model, states, actions, nextstates, policy=None, reg=0, prior=None,
 #Phat_ksa: model estimated from clustering dataset post-clustering
 ##################
 def classifyProj(dataclust, clusterlabs, hsubs, Phat_ksa, K, nStates, nActions):
-    #estimating frequency of k,s,a given s,a
-    freq_ksa = (np.array([
-                        helpers.getN_sa(dataclust[clusterlabs==k],
-                              nStates,nActions,reshape=True) 
-                          for k in range(K)])
-                /helpers.getN_sa(dataclust,nStates,nActions,
-                         reshape=True)[None,...])
-    
-    #forming matrix to eigendecompose
-    Mclust_sa = (freq_ksa[...,None,None] * 
-                 (Phat_ksa[...,None] @ Phat_ksa[...,None,:])).sum(0)
-    Mclust_sa = Mclust_sa + Mclust_sa.transpose(0,1,3,2)
-    
-    #eigendecomposition, get top K eigenvectors
-    eigvalclustsa, eigvecclustsa = np.linalg.eigh(Mclust_sa)
-    eigvalclust = eigvalclustsa[:,:,-K:]
-    eigvecclust = eigvecclustsa[:,:,:,-K:]
-    
-    #projection of each model to eigenspaces
-    projmod = (Phat_ksa[...,None,:] @ eigvecclust[None,...]).squeeze() #k, s, a, embed
-    #projection of each trajectory-wise-estimated-model to eigenspaces
-    projsub = (hsubs[..., None,:] @ eigvecclust[None,...]).squeeze() #i, n, s, a, embed
-    
-    #inner product for 'distances', max over s,a pairs, take argmax over mixture elements
-    projclass = (((projsub[0,None,...] - projmod[:,None,...]) * 
-                        (projsub[1,None,...] - projmod[:,None,...])).sum(-1))
-    projclass += np.random.uniform(high=1e-9, size=projclass.shape)
-    projclass = projclass.max((2,3)).argmax(0)
-    return projclass
+    return ProjClassifier.fromClusters(dataclust, clusterlabs, Phat_ksa, K,
+                                       nStates, nActions).predict(hsubs)
+
+#projections of h (N x S*A*S' csr, as geth_idx(sparse=True)) onto the
+#  per-(s,a) bases V (S, A, S', K), without densifying h; (N, S, A, K)
+def projectSparse(h, V):
+    nStates, nActions, nSp, K = V.shape
+    h = h.tocoo()
+    sa = h.col // nSp
+    out = np.zeros((h.shape[0]*nStates*nActions, K))
+    np.add.at(out, h.row*nStates*nActions + sa, h.data[:,None] * V.reshape((-1, nSp, K))[sa, h.col % nSp])
+    return out.reshape((h.shape[0], nStates, nActions, K))
+
+#Algorithm 3 with the eigenbasis computed once per fitted model.
+#  Mclust_sa = 2 sum_k freq_ksa P_ksa P_ksa^T has rank <= K, so its top K
+#  eigenvectors come from a QR of the K models and a K x K eigenproblem per
+#  (s,a). predict scores trajectories in blocks of chunk, expanding the inner
+#  product so no K x N x S x A x K tensor is formed.
+class ProjClassifier(object):
+    def __init__(self, Phat_ksa, freq_ksa):
+        K = len(Phat_ksa)
+        self.K = K
+        B = Phat_ksa.transpose(1, 2, 3, 0) #s, a, s', k
+        Q, Rq = np.linalg.qr(B)
+        C = Rq * freq_ksa.transpose(1, 2, 0)[:,:,None,:] @ Rq.transpose(0, 1, 3, 2)
+        eigvals, eigvecs = np.linalg.eigh(C + C.transpose(0, 1, 3, 2))
+        self.eigvalclust = eigvals
+        self.eigvecclust = Q @ eigvecs #s, a, s', K
+        self.projmod = np.einsum('ksap,sape->ksae', Phat_ksa, self.eigvecclust)
+        self.modnorm = (self.projmod**2).sum(-1)
+
+    #freq_ksa is the share of each (s,a) visit in cluster k, 0 where (s,a) is unvisited
+    @classmethod
+    def fromClusters(cls, dataclust, clusterlabs, Phat_ksa, K, nStates, nActions):
+        N_sa = suffstats.get_stats(dataclust, nStates, nActions)['N_sa']
+        N_ksa = np.array([suffstats.get_stats(dataclust, nStates, nActions,
+                              weights=(clusterlabs == k).astype(float))['N_sa'] for k in range(K)])
+        return cls(Phat_ksa, suffstats.safe_divide(N_ksa, N_sa[None]))
+
+    #projections of hsubs, dense (2, N, S, A, S') or a pair of csr matrices
+    def project(self, h):
+        if scipy.sparse.issparse(h):
+            return projectSparse(h, self.eigvecclust)
+        return np.einsum('nsap,sape->nsae', h, self.eigvecclust)
+
+    #(K, N) scores max_{s,a} (x0 - m_k).(x1 - m_k), labels are the argmax over k
+    def score(self, hsubs, chunk=256):
+        N = hsubs[0].shape[0]
+        scores = np.zeros((self.K, N))
+        for start in range(0, N, chunk):
+            x0 = self.project(hsubs[0][start:start + chunk])
+            x1 = self.project(hsubs[1][start:start + chunk])
+            d = (x0 * x1).sum(-1)
+            xs = x0 + x1
+            for k in range(self.K):
+                scores[k, start:start + chunk] = (d - np.einsum('nsae,sae->nsa', xs, self.projmod[k])
+                                                  + self.modnorm[k]).max((1, 2))
+        return scores
+
+    def predict(self, hsubs, chunk=256):
+        return self.score(hsubs, chunk=chunk).argmax(0)
     
 def em(expect, modelestim, states, actions, nextstates, labels, 
                 K, nStates, nActions, prior, 
@@ -229,3 +264,335 @@ def em(expect, modelestim, states, actions, nextstates, labels,
     if verbose:
         print('log-likelihood:', loglik)
     return expect, modelestim, loglik
+
+
+## SPARSE LOG-SPACE EM
+#Per-trajectory sufficient statistics, computed once: sparse counts of the
+#  (s,a,s') transitions (N x S*A*S), (s,a) pairs (N x S*A) and start states (N x S)
+class TrajStats(object):
+    def __init__(self, states, actions, nextstates, nStates, nActions):
+        states, actions, nextstates = [np.atleast_2d(np.asarray(x)).astype(np.int64)
+                                       for x in (states, actions, nextstates)]
+        N, T = states.shape
+        self.N, self.nStates, self.nActions = N, nStates, nActions
+        nSA = nStates*nActions
+        rows = np.repeat(np.arange(N), T)
+        sa = (states*nActions + actions).ravel()
+        ones = np.ones(N*T)
+        self.trans = scipy.sparse.csr_matrix((ones, (rows, sa*nStates + nextstates.ravel())),
+                                             shape=(N, nSA*nStates))
+        self.acts = scipy.sparse.csr_matrix((ones, (rows, sa)), shape=(N, nSA))
+        self.starts = scipy.sparse.csr_matrix((np.ones(N), (np.arange(N), states[:,0])),
+                                              shape=(N, nStates))
+
+    #weighted counts for each of the K rows of weights (K x N)
+    def counts(self, weights):
+        weights = np.asarray(weights, dtype=float)
+        K = weights.shape[0]
+        return ((self.trans.T @ weights.T).T.reshape((K, self.nStates, self.nActions, self.nStates)),
+                (self.acts.T @ weights.T).T.reshape((K, self.nStates, self.nActions)),
+                (self.starts.T @ weights.T).T)
+
+    #log-likelihood of every trajectory under every component, K x N
+    def loglik(self, logmodel, logpolicy=None, logstart=None):
+        K = len(logmodel)
+        ll = (self.trans @ logmodel.reshape((K, -1)).T).T
+        if logpolicy is not None:
+            ll += (self.acts @ logpolicy.reshape((K, -1)).T).T
+        if logstart is not None:
+            ll += (self.starts @ logstart.T).T
+        return ll
+
+#normalize counts over the last axis, rows without counts get fill
+def normalizeCounts(counts, fill):
+    tot = counts.sum(-1, keepdims=True)
+    return np.divide(counts, tot, out=np.full(counts.shape, float(fill)), where=tot > 0)
+
+#hard labels (N,) as K x N one-hot weights
+def labelWeights(expect, K):
+    expect = np.asarray(expect)
+    if expect.ndim == 2:
+        return expect
+    return (np.arange(K)[:,None] == expect[None,:]).astype(float)
+
+#M-step: model, policy, start weights and prior from the weights (K x N)
+def mStep(stats, expect):
+    trans, acts, starts = stats.counts(expect)
+    return [normalizeCounts(trans, 1/stats.nStates),
+            normalizeCounts(acts, 1/stats.nActions),
+            normalizeCounts(starts, 1/stats.nStates),
+            expect.sum(1)/expect.sum()]
+
+#E-step: posterior weights (or one-hot labels with hard=True) and the
+#  marginal log-likelihood sum_n log sum_k prior_k p(traj_n | k)
+def eStep(stats, model, policy, startweights, prior, hard=False):
+    with np.errstate(divide='ignore'):
+        logp = (stats.loglik(np.log(model), np.log(policy), np.log(startweights))
+                + np.log(prior)[:,None])
+    lse = logsumexp(logp, axis=0)
+    if hard:
+        expect = labelWeights(logp.argmax(0), len(logp))
+    else:
+        with np.errstate(invalid='ignore'):
+            expect = np.exp(logp - lse)
+        #trajectories impossible under every component
+        expect[:, ~np.isfinite(lse)] = 1/len(logp)
+    return expect, np.sum(lse)
+
+#one EM iteration from the weights expect (K x N, or hard labels)
+def emStep(stats, expect, K, hard=False):
+    model, policy, startweights, prior = mStep(stats, labelWeights(expect, K))
+    expect, loglik = eStep(stats, model, policy, startweights, prior, hard=hard)
+    return expect, [model, policy, startweights, prior], loglik
+
+#EM on precomputed TrajStats: each E-step is a sparse matmul against the log
+#  parameters with a log-sum-exp over components, each M-step a weighted sparse
+#  reduction. Stops when the relative change of the log-likelihood is below tol.
+#  Returns expect (labels if hard), modelestim and loglik like em, plus the
+#  fitted [model, policy, startweights, prior] and the log-likelihood trace.
+def emSparse(expect, states, actions, nextstates, K, nStates, nActions,
+             max_iter=100, min_iter=10, tol=1e-8, hard=False, stats=None,
+             labels=None, checkin=5, verbose=True):
+    if stats is None:
+        stats = TrajStats(states, actions, nextstates, nStates, nActions)
+    expect = labelWeights(expect, K)
+    trace = []
+    for i in range(max_iter):
+        expect, params, loglik = emStep(stats, expect, K, hard=hard)
+        trace.append(loglik)
+        if (i + 1) % checkin == 0 and verbose:
+            print('iteration', i + 1, 'log-likelihood', loglik)
+            if labels is not None:
+                expectlabs = expect.argmax(0)
+                print('accuracy:', max(np.mean(expectlabs == labels), np.mean(expectlabs != labels)))
+        if i >= 1 and i + 1 >= min_iter and abs(trace[-1] - trace[-2]) <= tol*abs(trace[-1]):
+            break
+    if verbose:
+        print('log-likelihood:', loglik)
+    if hard:
+        expect = expect.argmax(0)
+    return expect, params[0], loglik, params, trace
+
+
+## MULTI-RESTART EM
+#trajectory data shared read-only with the forked workers of emMultiRestart
+_restart = {}
+
+def emChain(r, expect, K, hard, max_iter, min_iter, tol, warmup, rel_margin):
+    stats, logliks = _restart['stats'], _restart['logliks']
+    states, actions, nextstates = _restart['data']
+    trace = []
+    status = 'max_iter'
+    for i in range(max_iter):
+        expect, params, _ = emStep(stats, expect, K, hard=hard)
+        loglik = getloglik(expect.argmax(0) if hard else expect, params[0],
+                           states, actions, nextstates, hard=hard)
+        trace.append(loglik)
+        logliks[r] = loglik
+        if i >= 1 and i + 1 >= min_iter and abs(trace[-1] - trace[-2]) <= tol*abs(loglik):
+            status = 'converged'
+            break
+        best = max(logliks[:])
+        if i + 1 >= warmup and loglik < best - rel_margin*abs(best):
+            status = 'abandoned'
+            break
+    return [expect, params, trace, status]
+
+#Runs R EM chains (emStep) concurrently in forked processes that share the
+#  trajectory arrays. Each chain publishes its current log-likelihood
+#  (getloglik) in a shared array and stops once, after warmup iterations, it is
+#  more than rel_margin * |best| behind the best chain.
+#  inits is a list of starting weights (K x N) or labels, by default random
+#  Dirichlet weights (random labels if hard) seeded from seed.
+#  Returns expect, modelestim and loglik of the best chain like em, plus the
+#  per-chain log-likelihood traces and statuses (converged/abandoned/max_iter).
+def emMultiRestart(states, actions, nextstates, K, nStates, nActions, R=8, inits=None,
+                   hard=False, max_iter=100, min_iter=10, tol=1e-8, warmup=5,
+                   rel_margin=0.01, seed=None, nprocs=None, verbose=True):
+    states, actions, nextstates = [np.asarray(x).astype(int) for x in (states, actions, nextstates)]
+    N = len(states)
+    if inits is None:
+        rngs = [np.random.default_rng(ss) for ss in np.random.SeedSequence(seed).spawn(R)]
+        if hard:
+            inits = [rng.integers(K, size=N) for rng in rngs]
+        else:
+            inits = [rng.dirichlet(np.ones(K), size=N).T for rng in rngs]
+    R = len(inits)
+    if nprocs is None:
+        nprocs = min(R, multiprocessing.cpu_count())
+    ctx = multiprocessing.get_context('fork')
+    logliks = ctx.Array('d', R, lock=False)
+    logliks[:] = [-np.inf]*R
+    _restart.update(stats=TrajStats(states, actions, nextstates, nStates, nActions),
+                    data=(states, actions, nextstates), logliks=logliks)
+    args = (K, hard, max_iter, min_iter, tol, warmup, rel_margin)
+    try:
+        if nprocs == 1:
+            results = [emChain(r, inits[r], *args) for r in range(R)]
+        else:
+            with ProcessPoolExecutor(max_workers=nprocs, mp_context=ctx) as executor:
+                futures = [executor.submit(emChain, r, inits[r], *args) for r in range(R)]
+                results = [f.result() for f in futures]
+    finally:
+        _restart.clear()
+    traces = [res[2] for res in results]
+    status = [res[3] for res in results]
+    best = int(np.argmax([trace[-1] for trace in traces]))
+    expect, params = results[best][:2]
+    if verbose:
+        print('best chain', best, 'log-likelihood:', traces[best][-1],
+              'abandoned:', status.count('abandoned'), 'of', R)
+    if hard:
+        expect = expect.argmax(0)
+    return expect, params[0], traces[best][-1], traces, status
+
+
+## ONLINE EM
+#Stochastic (online) EM: running per-trajectory sufficient statistics of the
+#  transitions, policy, start states and prior are updated from each
+#  mini-batch with step size (t0 + t)^-kappa, so memory is bounded by the
+#  batch size. Starting parameters can be given (e.g. from em on a first
+#  cohort), otherwise the first batch needs expect or starts from random ones.
+#  Starting parameters count as n_seen earlier mini-batches: the running
+#  statistics are seeded from them (see seedStats) and the first batch is
+#  blended in with step size (t0 + n_seen)^-kappa instead of replacing them.
+class OnlineEM(object):
+    def __init__(self, K, nStates, nActions, t0=2, kappa=0.6,
+                 model=None, policy=None, startweights=None, prior=None, n_seen=1, seed=None):
+        self.K, self.nStates, self.nActions = K, nStates, nActions
+        self.t0, self.kappa = t0, kappa
+        self.t = 0 if model is None else n_seen
+        self.stats = None
+        self.rng = np.random.default_rng(seed)
+        self.model, self.policy, self.startweights, self.prior = model, policy, startweights, prior
+        if model is not None:
+            if policy is None:
+                self.policy = np.full((K, nStates, nActions), 1/nActions)
+            if startweights is None:
+                self.startweights = np.full((K, nStates), 1/nStates)
+            if prior is None:
+                self.prior = np.full(K, 1/K)
+        self.loglik = None
+
+    def stepSize(self):
+        return 1. if self.stats is None else (self.t0 + self.t)**-self.kappa
+
+    #per-trajectory statistics that reproduce the current parameters, for
+    #  trajectories of T transitions spread uniformly over (s,a): each
+    #  component carries prior[k] trajectories
+    def seedStats(self, T):
+        w = self.prior[:,None,None]
+        return [w[...,None] * self.model * T/(self.nStates*self.nActions),
+                w * self.policy * T/self.nStates,
+                w[:,:,0] * self.startweights,
+                np.array(self.prior, dtype=float)]
+
+    #one stochastic EM step on a batch; expect (K x N weights or labels)
+    #  replaces the E-step, e.g. for a warm start from cluster labels
+    def partial_fit(self, states, actions, nextstates, expect=None):
+        stats = TrajStats(states, actions, nextstates, self.nStates, self.nActions)
+        if expect is None:
+            if self.model is None:
+                expect = self.rng.dirichlet(np.ones(self.K), size=stats.N).T
+            else:
+                expect, self.loglik = eStep(stats, self.model, self.policy,
+                                            self.startweights, self.prior)
+        expect = labelWeights(expect, self.K)
+        batch = [c/stats.N for c in stats.counts(expect)] + [expect.sum(1)/stats.N]
+        if self.stats is None and self.model is not None:
+            self.stats = self.seedStats(stats.trans.sum()/stats.N)
+        eta = self.stepSize()
+        if self.stats is None:
+            self.stats = batch
+        else:
+            self.stats = [(1 - eta)*old + eta*new for old, new in zip(self.stats, batch)]
+        self.t += 1
+        self.model = normalizeCounts(self.stats[0], 1/self.nStates)
+        self.policy = normalizeCounts(self.stats[1], 1/self.nActions)
+        self.startweights = normalizeCounts(self.stats[2], 1/self.nStates)
+        self.prior = self.stats[3]/self.stats[3].sum()
+        return self
+
+    #passes over in-memory data in mini-batches
+    def fit(self, states, actions, nextstates, batch_size=256, n_epochs=1, shuffle=True):
+        N = len(states)
+        for epoch in range(n_epochs):
+            order = self.rng.permutation(N) if shuffle else np.arange(N)
+            for start in range(0, N, batch_size):
+                idx = order[start:start + batch_size]
+                self.partial_fit(states[idx], actions[idx], nextstates[idx])
+        return self
+
+    #labels (or K x N log-probabilities with labs=False) of new trajectories, see classify
+    def classify(self, states, actions, nextstates, reg=0, labs=True):
+        return classify(self.model, states, actions, nextstates, policy=self.policy,
+                        reg=reg, prior=self.prior, startweights=self.startweights, labs=labs)
+
+
+## BATCHED CLASSIFICATION
+#Classifier for new trajectories against a fitted mixture, as classify but
+#  with the log model / policy / start tables cached once as float32 and the
+#  trajectories scored in chunks of at most chunk transitions (memory
+#  K x chunk). Trajectories may have different lengths: either flat arrays
+#  with offsets (trajectory i is [offsets[i], offsets[i+1])) or padded
+#  (N, T) arrays with a mask. A given prior enters as reg*log(prior), with
+#  reg = 1 (the Bayes posterior) unless set; reg=0 ignores it. Unlike
+#  classify, ties go to the first component instead of being broken with
+#  random jitter, and the default reg differs (classify ignores the prior
+#  unless reg > 0).
+class TrajClassifier(object):
+    def __init__(self, model, policy=None, startweights=None, prior=None, reg=None, dtype=np.float32):
+        K, nStates, nActions = model.shape[:3]
+        self.K, self.nStates, self.nActions = K, nStates, nActions
+        with np.errstate(divide='ignore'):
+            self.logmodel = np.log(model).reshape((K, -1)).astype(dtype)
+            self.logpolicy = None if policy is None else np.log(policy).reshape((K, -1)).astype(dtype)
+            self.logstart = None if startweights is None else np.log(startweights).astype(dtype)
+            if reg is None:
+                reg = 1
+            self.logprior = reg*np.log(prior) if prior is not None and reg > 0 else np.zeros(K)
+
+    #K x N log-likelihoods from flat int arrays and N+1 offsets
+    def scoreFlat(self, states, actions, nextstates, offsets, chunk=2**20):
+        offsets = np.asarray(offsets, dtype=np.int64)
+        N = len(offsets) - 1
+        probs = np.zeros((self.K, N))
+        i = 0
+        while i < N:
+            #trajectories [i, j) hold at most chunk transitions (at least one trajectory)
+            j = max(i + 1, np.searchsorted(offsets, offsets[i] + chunk, side='right') - 1)
+            j = min(j, N)
+            lo, hi = offsets[i], offsets[j]
+            s = np.asarray(states[lo:hi], dtype=np.int64)
+            a = np.asarray(actions[lo:hi], dtype=np.int64)
+            sa = s*self.nActions + a
+            steps = self.logmodel[:, sa*self.nStates + np.asarray(nextstates[lo:hi], dtype=np.int64)]
+            if self.logpolicy is not None:
+                steps += self.logpolicy[:, sa]
+            starts = offsets[i:j] - lo
+            nonempty = offsets[i+1:j+1] > offsets[i:j]
+            if hi > lo:
+                probs[:, i:j][:, nonempty] = np.add.reduceat(steps, starts[nonempty], axis=1, dtype=np.float64)
+                if self.logstart is not None:
+                    probs[:, i:j][:, nonempty] += self.logstart[:, s[starts[nonempty]]]
+            i = j
+        return probs + self.logprior[:,None]
+
+    #padded (N, T) arrays; mask (N, T) marks valid steps, by default actions >= 0
+    #  (DataGenerator pads with -1); valid steps must come first in each row
+    def score(self, states, actions, nextstates, mask=None, chunk=2**20):
+        states, actions, nextstates = [np.atleast_2d(np.asarray(x)) for x in (states, actions, nextstates)]
+        if mask is None:
+            mask = actions >= 0
+        lengths = mask.sum(1)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        return self.scoreFlat(states[mask], actions[mask], nextstates[mask], offsets, chunk=chunk)
+
+    #labels and posterior log-probabilities (K x N) under prior**reg
+    #  (normalized likelihoods without a prior)
+    def predict(self, states, actions, nextstates, mask=None, offsets=None, chunk=2**20):
+        if offsets is not None:
+            probs = self.scoreFlat(states, actions, nextstates, offsets, chunk=chunk)
+        else:
+            probs = self.score(states, actions, nextstates, mask=mask, chunk=chunk)
+        return probs.argmax(0), probs - logsumexp(probs, axis=0)
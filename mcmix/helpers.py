@@ -4,6 +4,8 @@ import multiprocessing
 from itertools import repeat
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import copy
+import mmap
+import suffstats
 
 def collect_sample(nsamples, mdp, pi_b, horizon, seed, iid=True):
     np.random.seed(seed)
@@ -15,14 +17,45 @@ def collect_sample(nsamples, mdp, pi_b, horizon, seed, iid=True):
     # x, a, u, x', r
     return dataset
 
-def getSamplesMultiProc(samples, mdp, pi_b, horizon, start_seed=0, iid=True, nprocs=None):
+# state inherited by the forked workers of getSamplesMultiProc
+_gen = {}
+
+def fillSamples(lo, hi, seed_seq):
+    mdp, pi_b, horizon, iid, out = _gen['args']
+    mdp.generate_trajectory_batch(pi_b, horizon, hi - lo, iid,
+                                  np.random.default_rng(seed_seq), out=out[lo:hi])
+    return hi - lo
+
+# Workers write straight into one preallocated (samples, horizon, 5) array:
+#    anonymous shared memory by default, or a np.memmap at memmap_path.
+#    The mdp and policy are inherited through fork rather than copied, work is
+#    split exactly (np.array_split) and every worker gets an independent
+#    stream from SeedSequence(start_seed).spawn
+def getSamplesMultiProc(samples, mdp, pi_b, horizon, start_seed=0, iid=True, nprocs=None,
+                        memmap_path=None):
     if nprocs is None:
         nprocs = multiprocessing.cpu_count()
-    with ProcessPoolExecutor(max_workers=nprocs, mp_context=multiprocessing.get_context('fork')) as executor:
-        future = executor.map(collect_sample, [int(samples/nprocs) for i in range(nprocs)], repeat(copy.deepcopy(mdp)), 
-                              repeat(copy.deepcopy(pi_b)), repeat(horizon), [i+start_seed for i in range(nprocs)], repeat(iid))
-    dataset = np.vstack(list(future))
-    return dataset
+    shape = (samples, horizon, 5)
+    if memmap_path is not None:
+        out = np.memmap(memmap_path, dtype=np.float64, mode='w+', shape=shape)
+    else:
+        buf = mmap.mmap(-1, max(1, int(np.prod(shape))) * 8)
+        out = np.frombuffer(buf, dtype=np.float64, count=int(np.prod(shape))).reshape(shape)
+    bounds = np.cumsum([0] + [len(c) for c in np.array_split(np.arange(samples), nprocs)])
+    seeds = np.random.SeedSequence(start_seed).spawn(nprocs)
+    mdp._transition_cdf() # build the sampling tables once, before forking
+    _gen['args'] = (mdp, pi_b, horizon, iid, out)
+    try:
+        with ProcessPoolExecutor(max_workers=nprocs, mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(fillSamples, bounds[i], bounds[i+1], seeds[i])
+                       for i in range(nprocs) if bounds[i+1] > bounds[i]]
+            assert sum(f.result() for f in futures) == samples
+    finally:
+        _gen.clear()
+    if memmap_path is not None:
+        out.flush()
+    # x, a, u, x', r
+    return out
 
 # Gets \mathbb{P}_{\pi_b}(s' | s, a), 
 #    the infinite-sample estimate of the transition probabilities
@@ -44,45 +77,23 @@ def getPb_spsa(nStates, nActions, u_dist, pi_b, pi_bsa, P):
 
 # Gets counts of occupancies of state-action tuples in dataset
 #    optional parameter burnin if one wants to only take counts past mixing time
+#    reshape=False takes an already flattened (n, 5) dataset
 def getN_sa(dataset, nStates, nActions, burnin=0, reshape=True):
-    N_sa = np.zeros((nStates, nActions))
-    if reshape:
-        resdata = dataset[:, burnin:, :].reshape(dataset[:, burnin:, :].shape[0]*dataset[:, burnin:, :].shape[1], 
-                                                     dataset[:, burnin:, :].shape[2])
-    else:
-        resdata = np.copy(dataset)
-    for s,a,u,sp,r in resdata:
-        N_sa[int(s),int(a)] += 1
-    return N_sa
+    if not reshape:
+        burnin = 0
+    return suffstats.get_stats(dataset, nStates, nActions, burnin)['N_sa'].copy()
 
 def getR_sa(dataset, nStates, nActions):
-    N_sa = getN_sa(dataset, nStates, nActions)
-    R_sa = np.zeros((nStates, nActions))
-    for s,a,u,sp,r in dataset.reshape(dataset.shape[0]*dataset.shape[1], 
-                                                     dataset.shape[2]):
-        R_sa[int(s),int(a)] += r
-    R_sa = (R_sa/N_sa)
-    R_sa[np.isnan(R_sa)] = 0
-    return R_sa
+    stats = suffstats.get_stats(dataset, nStates, nActions)
+    return suffstats.safe_divide(stats['R_sa'], stats['N_sa'])
 
 def getN_asp(dataset, nStates, nActions, burnin=0, reshape=True):
-    N_asp = np.zeros((nActions, nStates, nStates))
-    if reshape:
-        resdata = dataset[:, burnin:, :].reshape(dataset[:, burnin:, :].shape[0]*dataset[:, burnin:, :].shape[1], 
-                                                     dataset[:, burnin:, :].shape[2])
-    else:
-        resdata = np.copy(dataset)
-    for s,a,u,sp,r in resdata:
-        N_asp[int(a), int(s), int(sp)] += 1
-    return N_asp
+    if not reshape:
+        burnin = 0
+    N_sas = suffstats.get_stats(dataset, nStates, nActions, burnin)['N_sas']
+    return suffstats.to_asp(N_sas, nStates, nActions).copy()
 
 def getR_asp(dataset, nStates, nActions):
-    N_asp = getN_asp(dataset, nStates, nActions)
-    R_asp = np.zeros((nActions,nStates,nStates))
-    for s,a,u,sp,r in dataset.reshape(dataset.shape[0]*dataset.shape[1], 
-                                                     dataset.shape[2]):
-        R_asp[int(a), int(s), int(sp)] += r
-    R_asp = (R_asp/N_asp)
-    R_asp[np.isnan(R_asp)] = 0
-    return R_asp
-
+    stats = suffstats.get_stats(dataset, nStates, nActions)
+    return suffstats.safe_divide(suffstats.to_asp(stats['R_sas'], nStates, nActions),
+                                 suffstats.to_asp(stats['N_sas'], nStates, nActions))
@@ -0,0 +1,232 @@
+import numpy as np
+from .State import State
+from .Action import Action
+from tqdm import tqdm_notebook as tqdm
+
+'''
+Array-backed version of DataGenerator: every patient is a row of integer
+vitals / treatments and all active patients are advanced together.
+
+Columns of the state array (significance order of the 'full' index):
+    diabetic_idx, hr, sysbp, percoxyg, glucose, antibiotic, vaso, vent
+
+Transitions follow MDP.transition exactly (antibiotics, ventilation,
+vasopressors, fluctuations), so simulate() reproduces DataGenerator.simulate
+in distribution, including the non-diabetic glucose fluctuation capping at 1.
+'''
+
+DIAB, HR, SYSBP, OXYG, GLUC, ABX, VASO, VENT = range(8)
+
+CATEG_NUM = {
+    'full': np.array([2, 3, 3, 2, 5, 2, 2, 2]),
+    'obs': np.array([0, 3, 3, 2, 5, 2, 2, 2]),
+    'proj_obs': np.array([0, 3, 3, 2, 0, 2, 2, 2]),
+}
+
+def _idx_weights(idx_type):
+    categ_num = CATEG_NUM[idx_type]
+    weights = np.zeros(len(categ_num), dtype=int)
+    prev_base = 1
+    for i in reversed(range(len(categ_num))):
+        if categ_num[i] > 0:
+            weights[i] = prev_base
+            prev_base *= categ_num[i]
+    return weights
+
+IDX_WEIGHTS = {idx_type: _idx_weights(idx_type) for idx_type in CATEG_NUM}
+
+def get_state_idx(states, idx_type='obs'):
+    '''
+    integer index of each row, same arithmetic as State.get_state_idx
+    '''
+    return states @ IDX_WEIGHTS[idx_type]
+
+def states_from_idx(state_idx, idx_type='full', diabetic_idx=None):
+    '''
+    inverse of get_state_idx (glucose is set to normal for 'proj_obs')
+    '''
+    state_idx = np.asarray(state_idx)
+    states = np.zeros((state_idx.size, 8), dtype=int)
+    categ_num = CATEG_NUM[idx_type]
+    weights = IDX_WEIGHTS[idx_type]
+    for i in range(8):
+        if categ_num[i] > 0:
+            states[:, i] = (state_idx.ravel() // weights[i]) % categ_num[i]
+    if idx_type != 'full':
+        states[:, DIAB] = diabetic_idx
+    if idx_type == 'proj_obs':
+        states[:, GLUC] = 2
+    return states
+
+def get_num_abnormal(states):
+    return (states[:, HR] != 1).astype(int) + (states[:, SYSBP] != 1) + \
+        (states[:, OXYG] != 1) + (states[:, GLUC] != 2)
+
+def on_treatment(states):
+    return (states[:, ABX] == 1) | (states[:, VASO] == 1) | (states[:, VENT] == 1)
+
+def check_absorbing_state(states):
+    num_abnormal = get_num_abnormal(states)
+    return (num_abnormal >= 3) | ((num_abnormal == 0) & ~on_treatment(states))
+
+def calculate_reward(states):
+    num_abnormal = get_num_abnormal(states)
+    reward = np.zeros(len(states))
+    reward[(num_abnormal == 0) & ~on_treatment(states)] = 1
+    reward[num_abnormal >= 3] = -1
+    return reward
+
+def _draw(rng, p, size):
+    return (rng.random(size)[:, None] > np.cumsum(p)[None, :-1]).sum(1)
+
+def generate_random_states(n, p_diabetes, rng):
+    '''
+    same distribution as MDP.get_new_state() with no arguments: diabetes and
+    vitals are redrawn together until the state is not absorbing
+    '''
+    states = np.zeros((n, 8), dtype=int)
+    todo = np.arange(n)
+    while len(todo):
+        m = len(todo)
+        diab = (rng.random(m) < p_diabetes).astype(int)
+        states[todo, DIAB] = diab
+        states[todo, HR] = _draw(rng, [.25, .5, .25], m)
+        states[todo, SYSBP] = _draw(rng, [.25, .5, .25], m)
+        states[todo, OXYG] = _draw(rng, [.2, .8], m)
+        states[todo, GLUC] = np.where(diab == 0,
+            _draw(rng, [.05, .15, .6, .15, .05], m),
+            _draw(rng, [.01, .05, .15, .6, .19], m))
+        states[todo, ABX:] = 0
+        todo = todo[check_absorbing_state(states[todo])]
+    return states
+
+def transition(states, action_idx, rng):
+    '''
+    batched MDP.transition: updates states in place and returns the rewards
+    '''
+    n = len(states)
+    hr, sysbp, oxyg, gluc = [states[:, i] for i in (HR, SYSBP, OXYG, GLUC)]
+    diab = states[:, DIAB] == 1
+    abx, vaso, vent = [states[:, i] for i in (ABX, VASO, VENT)]
+    abx_on = (action_idx // 4) % 2 == 1
+    vent_on = (action_idx // 2) % 2 == 1
+    vaso_on = action_idx % 2 == 1
+
+    # antibiotics: on, hi -> normal w.p. .5; off, normal -> hi w.p. .1
+    abx_off = ~abx_on & (abx == 1)
+    hr[abx_on & (hr == 2) & (rng.random(n) < 0.5)] = 1
+    sysbp[abx_on & (sysbp == 2) & (rng.random(n) < 0.5)] = 1
+    hr[abx_off & (hr == 1) & (rng.random(n) < 0.1)] = 2
+    sysbp[abx_off & (sysbp == 1) & (rng.random(n) < 0.1)] = 2
+    abx[abx_on] = 1
+    abx[abx_off] = 0
+    hr_fluctuate = ~(abx_on | abx_off)
+    sysbp_fluctuate = hr_fluctuate.copy()
+
+    # ventilation: on, low -> normal w.p. .7; off, normal -> low w.p. .1
+    vent_off = ~vent_on & (vent == 1)
+    oxyg[vent_on & (oxyg == 0) & (rng.random(n) < 0.7)] = 1
+    oxyg[vent_off & (oxyg == 1) & (rng.random(n) < 0.1)] = 0
+    vent[vent_on] = 1
+    vent[vent_off] = 0
+    oxyg_fluctuate = ~(vent_on | vent_off)
+
+    # vasopressors, see MDP.transition_vaso_on / transition_vaso_off
+    vaso_off = ~vaso_on & (vaso == 1)
+    up = vaso_on & ~diab & (rng.random(n) < 0.7) & (sysbp < 2)
+    up_prob = rng.random(n)
+    up_diab_1 = vaso_on & diab & (sysbp == 1) & (up_prob < 0.9)
+    up_diab_0 = vaso_on & diab & (sysbp == 0)
+    sysbp[up] += 1
+    sysbp[up_diab_1] = 2
+    sysbp[up_diab_0 & (up_prob < 0.5)] = 1
+    sysbp[up_diab_0 & (up_prob >= 0.5) & (up_prob < 0.9)] = 2
+    gluc_up = vaso_on & diab & (rng.random(n) < 0.5)
+    gluc[gluc_up] = np.minimum(4, gluc[gluc_up] + 1)
+    down = vaso_off & (rng.random(n) < np.where(diab, 0.05, 0.1))
+    sysbp[down] = np.maximum(0, sysbp[down] - 1)
+    vaso[vaso_on] = 1
+    vaso[vaso_off] = 0
+    sysbp_fluctuate &= ~(vaso_on | vaso_off)
+    gluc_fluctuate = ~vaso_on
+
+    # fluctuations, +/- 1 w.p. .1 (glucose .3 if diabetic)
+    for vital, fluctuate, hi in ((hr, hr_fluctuate, 2),
+            (sysbp, sysbp_fluctuate, 2), (oxyg, oxyg_fluctuate, 1)):
+        prob = rng.random(n)
+        dn = fluctuate & (prob < 0.1)
+        vital[dn] = np.maximum(0, vital[dn] - 1)
+        vup = fluctuate & (prob >= 0.1) & (prob < 0.2)
+        vital[vup] = np.minimum(hi, vital[vup] + 1)
+    prob = rng.random(n)
+    p_fl = np.where(diab, 0.3, 0.1)
+    dn = gluc_fluctuate & (prob < p_fl)
+    vup = gluc_fluctuate & (prob >= p_fl) & (prob < 2*p_fl)
+    gluc[dn] = np.maximum(0, gluc[dn] - 1)
+    # non-diabetics are capped at 1, as in MDP.transition_fluctuate
+    gluc[vup] = np.minimum(np.where(diab[vup], 4, 1), gluc[vup] + 1)
+
+    states[:, HR], states[:, SYSBP], states[:, OXYG], states[:, GLUC] = \
+        hr, sysbp, oxyg, gluc
+    states[:, ABX], states[:, VASO], states[:, VENT] = abx, vaso, vent
+    return calculate_reward(states)
+
+def select_actions(states, policy, policy_idx_type, rng):
+    cdf = np.cumsum(policy[get_state_idx(states, policy_idx_type)], axis=1)
+    action_idx = (rng.random(len(states))[:, None] >= cdf).sum(1)
+    return np.minimum(action_idx, Action.NUM_ACTIONS_TOTAL - 1)
+
+class BatchDataGenerator(object):
+
+    def simulate(self, num_iters, max_num_steps,
+            policy=None, policy_idx_type='full', p_diabetes=0.2,
+            output_state_idx_type='obs', use_tqdm=False, tqdm_desc='',
+            rng=None):
+        '''
+        same arguments and outputs as DataGenerator.simulate
+        '''
+        assert policy is not None, "Please specify a policy"
+        if rng is None:
+            rng = np.random.default_rng()
+
+        iter_states = np.ones((num_iters, max_num_steps+1, 1), dtype=int)*(-1)
+        iter_actions = np.ones((num_iters, max_num_steps, 1), dtype=int)*(-1)
+        iter_rewards = np.zeros((num_iters, max_num_steps, 1))
+        iter_lengths = np.zeros((num_iters, 1), dtype=int)
+
+        if output_state_idx_type == 'obs':
+            nS = State.NUM_OBS_STATES
+        elif output_state_idx_type == 'full':
+            nS = State.NUM_FULL_STATES
+        else:
+            raise NotImplementedError()
+        emp_tx_mat = np.zeros((Action.NUM_ACTIONS_TOTAL, nS, nS))
+        emp_r_mat = np.zeros((Action.NUM_ACTIONS_TOTAL, nS, nS))
+
+        states = generate_random_states(num_iters, p_diabetes, rng)
+        iter_component = np.repeat(states[:, DIAB, None, None], max_num_steps, axis=1)
+        iter_states[:, 0, 0] = get_state_idx(states, output_state_idx_type)
+        iter_lengths[:, 0] = max_num_steps
+
+        active = np.arange(num_iters)
+        for step in tqdm(range(max_num_steps), disable=not(use_tqdm), desc=tqdm_desc):
+            if len(active) == 0:
+                break
+            st = states[active]
+            action_idx = select_actions(st, policy, policy_idx_type, rng)
+            from_idx = get_state_idx(st, output_state_idx_type)
+            reward = transition(st, action_idx, rng)
+            to_idx = get_state_idx(st, output_state_idx_type)
+            states[active] = st
+
+            iter_actions[active, step, 0] = action_idx
+            iter_states[active, step+1, 0] = to_idx
+            np.add.at(emp_tx_mat, (action_idx, from_idx, to_idx), 1)
+            np.add.at(emp_r_mat, (action_idx, from_idx, to_idx), reward)
+
+            done = reward != 0
+            iter_rewards[active[done], step, 0] = reward[done]
+            iter_lengths[active[done], 0] = step+1
+            active = active[~done]
+
+        return iter_states, iter_actions, iter_lengths, iter_rewards, iter_component, emp_tx_mat, emp_r_mat
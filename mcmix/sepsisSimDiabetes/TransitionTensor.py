@@ -0,0 +1,255 @@
+import hashlib
+import inspect
+import os
+import numpy as np
+import scipy.sparse as sp
+from .State import State
+from .Action import Action
+from . import MDP
+from .BatchDataGenerator import DIAB, HR, SYSBP, OXYG, GLUC, ABX, VASO, VENT, \
+    CATEG_NUM, get_state_idx, states_from_idx, calculate_reward, \
+    check_absorbing_state
+
+'''
+Exact transition / reward tensors for the sepsis simulator.
+
+Instead of estimating tx_mat by sampling MDP.transition (learn_mdp_parameters),
+every full state (1440) and action (8) is pushed through the same
+antibiotic / ventilation / vasopressor / fluctuation logic as weighted
+branches, giving the exact next-state distribution.
+
+load_txr_mats() returns the same dict as data/diab_txr_mats-replication.pkl,
+with tx_mat / r_mat as (n_components x n_actions) nested lists of csr_matrix
+(see MatrixMDP(sparse=True)), and caches it on disk under a hash of the
+simulator source and parameters.
+'''
+
+# Extra particle columns: which vitals still fluctuate after the treatments
+HR_FL, SYSBP_FL, OXYG_FL, GLUC_FL = range(8, 12)
+
+def _set(col, val):
+    def update(s):
+        s[:, col] = val
+    return update
+
+def _shift(col, step, lo=0, hi=None):
+    def update(s):
+        s[:, col] = np.clip(s[:, col] + step, lo, hi)
+    return update
+
+def _branch(particles, weights, mask, outcomes):
+    '''
+    split the particles selected by mask: outcome (p, update) keeps weight * p
+    and applies update (None leaves the state unchanged)
+    '''
+    parts, wts = [particles[~mask]], [weights[~mask]]
+    for p, update in outcomes:
+        s = particles[mask].copy()
+        if update is not None:
+            update(s)
+        parts.append(s)
+        wts.append(weights[mask] * p)
+    particles, weights = np.concatenate(parts), np.concatenate(wts)
+    keep = weights > 0
+    return _merge(particles[keep], weights[keep])
+
+def _merge(particles, weights):
+    # collapse identical (source, state, flags) particles
+    key, inv = np.unique(particles, axis=0, return_inverse=True)
+    return key, np.bincount(inv.ravel(), weights=weights)
+
+def exact_transition(action_idx, from_states):
+    '''
+    exact MDP.transition for one action from every row of from_states
+
+    :returns: (source row, next states, probability) for every reachable pair
+    '''
+    n = len(from_states)
+    particles = np.zeros((n, 13), dtype=int)
+    particles[:, :8] = from_states
+    particles[:, 8:12] = 1
+    particles[:, 12] = np.arange(n)
+    weights = np.ones(n)
+    col = lambda c: particles[:, c]
+
+    # antibiotics
+    if (action_idx // 4) % 2 == 1:
+        particles, weights = _branch(particles, weights, col(HR) == 2,
+            [(0.5, _set(HR, 1)), (0.5, None)])
+        particles, weights = _branch(particles, weights, col(SYSBP) == 2,
+            [(0.5, _set(SYSBP, 1)), (0.5, None)])
+        particles[:, ABX] = 1
+        particles[:, HR_FL] = particles[:, SYSBP_FL] = 0
+    else:
+        off = col(ABX) == 1
+        particles, weights = _branch(particles, weights, off & (col(HR) == 1),
+            [(0.1, _set(HR, 2)), (0.9, None)])
+        off = col(ABX) == 1
+        particles, weights = _branch(particles, weights, off & (col(SYSBP) == 1),
+            [(0.1, _set(SYSBP, 2)), (0.9, None)])
+        off = col(ABX) == 1
+        particles[off, HR_FL] = particles[off, SYSBP_FL] = 0
+        particles[off, ABX] = 0
+
+    # ventilation
+    if (action_idx // 2) % 2 == 1:
+        particles, weights = _branch(particles, weights, col(OXYG) == 0,
+            [(0.7, _set(OXYG, 1)), (0.3, None)])
+        particles[:, VENT] = 1
+        particles[:, OXYG_FL] = 0
+    else:
+        off = col(VENT) == 1
+        particles, weights = _branch(particles, weights, off & (col(OXYG) == 1),
+            [(0.1, _set(OXYG, 0)), (0.9, None)])
+        off = col(VENT) == 1
+        particles[off, OXYG_FL] = 0
+        particles[off, VENT] = 0
+
+    # vasopressors
+    if action_idx % 2 == 1:
+        diab = col(DIAB) == 1
+        particles, weights = _branch(particles, weights, ~diab & (col(SYSBP) < 2),
+            [(0.7, _shift(SYSBP, 1)), (0.3, None)])
+        diab = col(DIAB) == 1
+        particles, weights = _branch(particles, weights, diab & (col(SYSBP) == 1),
+            [(0.9, _set(SYSBP, 2)), (0.1, None)])
+        diab = col(DIAB) == 1
+        particles, weights = _branch(particles, weights, diab & (col(SYSBP) == 0),
+            [(0.5, _set(SYSBP, 1)), (0.4, _set(SYSBP, 2)), (0.1, None)])
+        diab = col(DIAB) == 1
+        particles, weights = _branch(particles, weights, diab,
+            [(0.5, _shift(GLUC, 1, hi=4)), (0.5, None)])
+        particles[:, VASO] = 1
+        particles[:, SYSBP_FL] = particles[:, GLUC_FL] = 0
+    else:
+        off = col(VASO) == 1
+        particles, weights = _branch(particles, weights, off & (col(DIAB) == 0),
+            [(0.1, _shift(SYSBP, -1)), (0.9, None)])
+        off = col(VASO) == 1
+        particles, weights = _branch(particles, weights, off & (col(DIAB) == 1),
+            [(0.05, _shift(SYSBP, -1)), (0.95, None)])
+        off = col(VASO) == 1
+        particles[off, SYSBP_FL] = 0
+        particles[off, VASO] = 0
+
+    # fluctuations
+    for c, fl, hi in ((HR, HR_FL, 2), (SYSBP, SYSBP_FL, 2), (OXYG, OXYG_FL, 1)):
+        particles, weights = _branch(particles, weights, col(fl) == 1,
+            [(0.1, _shift(c, -1)), (0.1, _shift(c, 1, hi=hi)), (0.8, None)])
+    # non-diabetics are capped at 1, as in MDP.transition_fluctuate
+    particles, weights = _branch(particles, weights,
+        (col(GLUC_FL) == 1) & (col(DIAB) == 0),
+        [(0.1, _shift(GLUC, -1)), (0.1, _shift(GLUC, 1, hi=1)), (0.8, None)])
+    particles, weights = _branch(particles, weights,
+        (col(GLUC_FL) == 1) & (col(DIAB) == 1),
+        [(0.3, _shift(GLUC, -1)), (0.3, _shift(GLUC, 1, hi=4)), (0.4, None)])
+
+    # drop the fluctuation flags before merging outcomes
+    particles = np.concatenate([particles[:, :8], particles[:, 12:]], axis=1)
+    particles, weights = _merge(particles, weights)
+    return particles[:, 8], particles[:, :8], weights
+
+def exact_tx_full():
+    '''
+    :returns: list over actions of (1440 x 1440) csr_matrix on full indices
+    '''
+    nS = State.NUM_FULL_STATES
+    from_states = states_from_idx(np.arange(nS), 'full')
+    tx = []
+    for a in range(Action.NUM_ACTIONS_TOTAL):
+        src, to_states, p = exact_transition(a, from_states)
+        tx.append(sp.csr_matrix((p, (src, get_state_idx(to_states, 'full'))),
+                                shape=(nS, nS)))
+    return tx
+
+def exact_initial_state():
+    '''
+    exact MDP.get_new_state() distribution per component, (2 x 720)
+    '''
+    p = [[.25, .5, .25], [.25, .5, .25], [.2, .8]]
+    p_gluc = [[.05, .15, .6, .15, .05], [.01, .05, .15, .6, .19]]
+    p_init = np.zeros((State.NUM_HID_STATES, State.NUM_OBS_STATES))
+    states = states_from_idx(np.arange(State.NUM_FULL_STATES), 'full')
+    untreated = (states[:, ABX:] == 0).all(1)
+    for c in range(State.NUM_HID_STATES):
+        st = states[untreated & (states[:, DIAB] == c)]
+        prob = np.prod([np.take(p[i], st[:, col])
+                        for i, col in enumerate((HR, SYSBP, OXYG))], axis=0)
+        prob *= np.take(p_gluc[c], st[:, GLUC])
+        prob[check_absorbing_state(st)] = 0
+        p_init[c, get_state_idx(st, 'obs')] = prob / prob.sum()
+    return p_init
+
+def build_txr_mats(p_diabetes=0.2):
+    '''
+    same fields as diab_txr_mats-replication.pkl, split by diabetes status on
+    observed indices. r_mat only stores entries on the support of tx_mat
+    (reward of the state transitioned to), so expected rewards are unchanged.
+    '''
+    nS = State.NUM_OBS_STATES
+    r_state = calculate_reward(states_from_idx(np.arange(nS), 'obs', 0))
+    tx_mat, r_mat = [], []
+    tx_full = exact_tx_full()
+    for c in range(State.NUM_HID_STATES):
+        block = slice(c*nS, (c+1)*nS)
+        tx_c = [sp.csr_matrix(tx_a[block, block]) for tx_a in tx_full]
+        tx_mat.append(tx_c)
+        r_c = [tx_a.copy() for tx_a in tx_c]
+        for r_a in r_c:
+            r_a.data = r_state[r_a.indices]
+        r_mat.append(r_c)
+    return {"tx_mat": tx_mat,
+            "r_mat": r_mat,
+            "p_initial_state": exact_initial_state(),
+            "p_mixture": np.array([1 - p_diabetes, p_diabetes])}
+
+def sim_hash(p_diabetes=0.2):
+    '''
+    content hash of the simulator logic and parameters the tensors depend on
+    '''
+    h = hashlib.sha1()
+    for obj in (MDP.MDP, _branch, exact_transition, exact_initial_state, build_txr_mats):
+        h.update(inspect.getsource(obj).encode())
+    h.update(repr([CATEG_NUM['full'].tolist(), Action.NUM_ACTIONS_TOTAL,
+                   float(p_diabetes)]).encode())
+    return h.hexdigest()[:16]
+
+def load_txr_mats(p_diabetes=0.2, cache_dir=None, dense=False):
+    '''
+    exact tx / r matrices, built once and cached on disk
+
+    :param dense: return (n_components x n_actions x n_states x n_states)
+    arrays like the pickled replication matrices instead of csr lists
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(__file__), '..', 'data')
+    path = os.path.join(cache_dir,
+                        'exact_txr_mats-{}.npz'.format(sim_hash(p_diabetes)))
+    nC, nA = State.NUM_HID_STATES, Action.NUM_ACTIONS_TOTAL
+    nS = State.NUM_OBS_STATES
+
+    if os.path.exists(path):
+        f = np.load(path)
+        stacked = {k: sp.csr_matrix((f[k + '_data'], f[k + '_indices'],
+                   f[k + '_indptr']), shape=(nC*nA*nS, nS)) for k in ('tx', 'r')}
+        mats = {"p_initial_state": f["p_initial_state"], "p_mixture": f["p_mixture"]}
+        for k in ('tx', 'r'):
+            mats[k + '_mat'] = [[stacked[k][(c*nA + a)*nS:(c*nA + a + 1)*nS]
+                                 for a in range(nA)] for c in range(nC)]
+    else:
+        mats = build_txr_mats(p_diabetes)
+        arrays = {"p_initial_state": mats["p_initial_state"],
+                  "p_mixture": mats["p_mixture"]}
+        for k in ('tx', 'r'):
+            stacked = sp.vstack([m for m_c in mats[k + '_mat'] for m in m_c],
+                                format='csr')
+            arrays[k + '_data'] = stacked.data
+            arrays[k + '_indices'] = stacked.indices
+            arrays[k + '_indptr'] = stacked.indptr
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez_compressed(path, **arrays)
+
+    if dense:
+        for k in ('tx_mat', 'r_mat'):
+            mats[k] = np.array([[m.toarray() for m in m_c] for m_c in mats[k]])
+    return mats
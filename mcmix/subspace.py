@@ -1,41 +1,76 @@
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
 from numba import jit, njit, prange
 from tqdm import tqdm
-import tensorflow as tf
+from trajstore import TrajStore
 
 ## ALGORITHM: SUBSPACE ESTIMATION
 
 
-#Function to estimate h, array of empirical next state probabilities given state and action
-@njit(parallel=True, cache=True)
-def geth(onehotsa, onehotsp, simple=False):
-    h = np.zeros((onehotsa.shape[0], onehotsa.shape[2], onehotsa.shape[3], onehotsa.shape[2])) #m, s, a, sp
-    N_msa = np.zeros((onehotsa.shape[0], onehotsa.shape[2], onehotsa.shape[3]))
-    for m in range(onehotsa.shape[0]):
-        for s in range(onehotsa.shape[2]):
-            for a in range(onehotsa.shape[3]):
-                for sp in range(onehotsa.shape[2]):
-                    for t in range(onehotsa.shape[1]):
-                        h[m,s,a,sp] += onehotsa[m,t,s,a]*onehotsp[m,t,sp]
-                        N_msa[m,s,a] += onehotsa[m,t,s,a]
-    if not simple:
-        for m in range(onehotsa.shape[0]):
-            for s in range(onehotsa.shape[2]):
-                for a in range(onehotsa.shape[3]):
-                    for sp in range(onehotsa.shape[2]):
-                        if N_msa[m,s,a] != 0:
-                            h[m,s,a,sp] /= N_msa[m,s,a]
-                        else:
-                            h[m,s,a,sp] = 0
+#Function to estimate h, array of empirical next state probabilities given state and action,
+#  from integer (m,T) arrays of states, actions and next states in O(m T).
+#  h[m,s,a,:] is normalized by the visits N_msa (or by T with simple=True).
+#  sparse=True returns a csr matrix with rows m and columns (s*nActions + a)*nStates + sp
+def geth_idx(states, actions, nextstates, nStates, nActions, simple=False, sparse=False):
+    states, actions, nextstates = [np.atleast_2d(np.asarray(x)).astype(np.int64)
+                                   for x in (states, actions, nextstates)]
+    m, T = states.shape
+    nSA = nStates*nActions
+    rows = np.repeat(np.arange(m), T)
+    msa = rows*nSA + (states*nActions + actions).ravel()
+    cols = msa % nSA * nStates + nextstates.ravel()
+    if simple:
+        w = np.full(m*T, 1/T)
     else:
-        h /= onehotsa.shape[1]
-    return h
+        _, inv, N_msa = np.unique(msa, return_inverse=True, return_counts=True)
+        w = 1/N_msa[inv.ravel()]
+    if sparse:
+        return scipy.sparse.csr_matrix((w, (rows, cols)), shape=(m, nSA*nStates))
+    return np.bincount(rows*nSA*nStates + cols, weights=w,
+                       minlength=m*nSA*nStates).reshape((m, nStates, nActions, nStates))
+
+#h from one-hot onehotsa (m,t,s,a) and onehotsp (m,t,sp), see geth_idx
+#  (N_msa used to be counted once per s', which scaled h down by 1/S)
+def geth(onehotsa, onehotsp, simple=False):
+    m, T, nStates, nActions = onehotsa.shape
+    sa = onehotsa.reshape((m, T, nStates*nActions)).argmax(-1)
+    return geth_idx(sa // nActions, sa % nActions, onehotsp.argmax(-1), nStates, nActions, simple=simple)
+
+#h on the time steps t of either one-hot arrays or a TrajStore
+def gethWindow(onehotsa, onehotsp, t, sparse=False):
+    if isinstance(onehotsa, TrajStore):
+        w = onehotsa.window(t)
+        return geth_idx(w.s, w.a, w.sp, w.nStates, w.nActions, sparse=sparse)
+    h = geth(*onehots(onehotsa, onehotsp, t))
+    return scipy.sparse.csr_matrix(h.reshape((len(h), -1))) if sparse else h
+
+#visits of each (s,a) per trajectory on the time steps t, (m,s,a)
+def getN_msa(onehotsa, t):
+    if isinstance(onehotsa, TrajStore):
+        w = onehotsa.window(t)
+        nSA = w.nStates*w.nActions
+        m = len(w)
+        return np.bincount((np.arange(m)[:, None]*nSA + w.sa_idx()).ravel(),
+                           minlength=m*nSA).reshape((m, w.nStates, w.nActions))
+    return onehotsa[:,t,:,:].sum(axis=1)
+
+#one-hot (m,t,s,a) and (m,t,sp) arrays on the time steps t; onehotsa can also
+#  be a TrajStore (with onehotsp=None), then only that window is materialized
+def onehots(onehotsa, onehotsp, t):
+    if isinstance(onehotsa, TrajStore):
+        return onehotsa.onehot_sa(t), onehotsa.onehot_sp(t)
+    return onehotsa[:,t,:,:], onehotsp[:,t,:]
 
 #function to get projections of next state probabilities to rank K subspaces
-def getEig(onehotsa, onehotsp, omegaone, omegatwo, K, wt = True, smalldata=True, device='/CPU:0'):
+#  smalldata=False streams trajectories through getEigStream instead of
+#  materializing Hsa for every trajectory (device is no longer used)
+def getEig(onehotsa, onehotsp, omegaone, omegatwo, K, wt = True, smalldata=True, device='/CPU:0', chunk=256):
+    if not smalldata:
+        return getEigStream(onehotsa, onehotsp, omegaone, omegatwo, K, wt=wt, chunk=chunk)
     #h1 and h2 are shaped (m,s,a,s')
-    h1 = np.array(geth(onehotsa[:,omegaone,:,:], onehotsp[:,omegaone,:]), dtype=np.float32)
-    h2 = np.array(geth(onehotsa[:,omegatwo,:,:], onehotsp[:,omegatwo,:]), dtype=np.float32)
+    h1 = np.array(gethWindow(onehotsa, onehotsp, omegaone), dtype=np.float32)
+    h2 = np.array(gethWindow(onehotsa, onehotsp, omegatwo), dtype=np.float32)
     
     #Hsa = (h1 * h2).sum(3).mean(0)
     #Hsa = h1[:,:,:,:,None] * h2[:,:,:,None,:]
@@ -48,36 +83,87 @@ def getEig(onehotsa, onehotsp, omegaone, omegatwo, K, wt = True, smalldata=True,
         invwts = np.ones((nStates, nActions))
     else:
         #trajwts is shaped (s,a)
-        trajwts = (onehotsa[:,omegaone,:,:].sum(axis=1) * onehotsa[:,omegatwo,:,:].sum(axis=1)).sum(0)
+        trajwts = (getN_msa(onehotsa, omegaone) * getN_msa(onehotsa, omegatwo)).sum(0)
         invwts = 1/trajwts
         (invwts)[np.isinf(invwts)] = 0
-    if smalldata:
-        Hsa = ((h1[...,None] @ h2[...,None,:])*invwts[None,:,:,None,None]).sum(0)
-    else:
-        with tf.device(device):
-            Hsa = tf.zeros((nStates, nActions, nStates, nStates), dtype=tf.float32)
-            #Hsa = [[tf.zeros((nStates, nStates), dtype=tf.float32) for a in range(nActions)] for s in range(nStates)]
-            for m in tqdm(range(len(h1))):
-                Hsa += (tf.convert_to_tensor(h1[m,:,:,:,None], np.float32) 
-                        @ tf.convert_to_tensor(h2[m,:,:,None,:], np.float32))*invwts[:,:,None,None]
-                #for s in range(nStates):
-                #    for a in range(nActions):
-                #        Hsa[s][a] += (tf.convert_to_tensor(h1[m,s,a,:,None], np.float32) 
-                #                     @ tf.convert_to_tensor(h2[m,s,a,None,:], np.float32))*invwts[s,a]
-            
-            Hsa = Hsa.numpy()/len(h1)
-            #for s in range(nStates):
-            #    for a in range(nActions):
-            #        Hsa[s][a] = Hsa[s][a].numpy()/len(h1)
-    Hsa = np.array(Hsa)
+    Hsa = ((h1[...,None] @ h2[...,None,:])*invwts[None,:,:,None,None]).sum(0)
     Hsa = Hsa + Hsa.transpose(0,1,3,2)
     eigvalsa, eigvecsa = np.linalg.eigh(Hsa)
     return eigvalsa[:,:,-K:], eigvecsa[:,:,:,-K:]
 
+#sum over trajectories of the outer products h1[m,s,a,:] h2[m,s,a,:]^T as a
+#  sparse (S*A*S, S) matrix, block s*A + a holding the (s,a) S by S matrix
+def accumHsa(h1, h2, nStates, nActions):
+    nSA = nStates*nActions
+    h1, h2 = h1.tocoo(), h2.tocoo()
+    #rows (m, s, a); h1 keeps its (s, a, sp) column so the product is block diagonal
+    Y1 = scipy.sparse.csr_matrix((h1.data, (h1.row*nSA + h1.col//nStates, h1.col)),
+                                 shape=(h1.shape[0]*nSA, nSA*nStates))
+    X2 = scipy.sparse.csr_matrix((h2.data, (h2.row*nSA + h2.col//nStates, h2.col%nStates)),
+                                 shape=(h2.shape[0]*nSA, nStates))
+    return (Y1.T @ X2).tocsr()
+
+#top K eigenpairs of a symmetric sparse S by S matrix, solved on the rows /
+#  columns it touches (dense eigh, or Lanczos with eigsh for large supports);
+#  the rest of the spectrum is zero with unit eigenvectors
+def topEig(H, K, dense_max=200):
+    nStates = H.shape[0]
+    H = H.tocoo()
+    support = np.union1d(H.row, H.col)
+    vals = np.zeros(0)
+    vecs = np.zeros((nStates, 0))
+    if len(support):
+        Hs = H.tocsr()[support][:, support]
+        if len(support) <= max(dense_max, K + 1):
+            vals, v = np.linalg.eigh(Hs.toarray())
+            vals, v = vals[-K:], v[:, -K:]
+        else:
+            vals, v = scipy.sparse.linalg.eigsh(Hs, k=K, which='LA')
+        vecs = np.zeros((nStates, len(vals)))
+        vecs[support] = v
+    rest = np.setdiff1d(np.arange(nStates), support)[:K]
+    vals = np.concatenate([vals, np.zeros(len(rest))])
+    vecs = np.concatenate([vecs, np.eye(nStates)[:, rest]], axis=1)
+    order = np.argsort(vals, kind='stable')[-K:]
+    return vals[order], vecs[:, order]
+
+#getEig for large data: trajectories are streamed in chunks, h is kept sparse
+#  and Hsa is accumulated per (s,a) on the support of h, then only the top K
+#  eigenpairs of each block are computed. Hsa is averaged over trajectories as
+#  in the old smalldata=False path.
+def getEigStream(onehotsa, onehotsp, omegaone, omegatwo, K, wt=True, chunk=256):
+    if isinstance(onehotsa, TrajStore):
+        m, nStates, nActions = len(onehotsa), onehotsa.nStates, onehotsa.nActions
+    else:
+        m, _, nStates, nActions = onehotsa.shape
+    Hsa = scipy.sparse.csr_matrix((nStates*nActions*nStates, nStates))
+    trajwts = np.zeros((nStates, nActions))
+    for start in tqdm(range(0, m, chunk)):
+        sl = slice(start, start + chunk)
+        sub = onehotsa[sl]
+        subp = None if onehotsp is None else onehotsp[sl]
+        Hsa = Hsa + accumHsa(gethWindow(sub, subp, omegaone, sparse=True),
+                             gethWindow(sub, subp, omegatwo, sparse=True), nStates, nActions)
+        if wt:
+            trajwts += (getN_msa(sub, omegaone) * getN_msa(sub, omegatwo)).sum(0)
+    if not wt:
+        invwts = np.ones((nStates, nActions))
+    else:
+        invwts = 1/trajwts
+        (invwts)[np.isinf(invwts)] = 0
+    eigvalsa = np.zeros((nStates, nActions, K))
+    eigvecsa = np.zeros((nStates, nActions, nStates, K))
+    for s in range(nStates):
+        for a in range(nActions):
+            sa = s*nActions + a
+            block = Hsa[sa*nStates:(sa+1)*nStates] * (invwts[s,a] / m)
+            eigvalsa[s,a], eigvecsa[s,a] = topEig(block + block.T, K)
+    return eigvalsa, eigvecsa
+
 #function to get projections of occupancy measures to rank K subspaces
 def getEigKs(onehotsa, onehotsp, omegaone, omegatwo, K):
-    k1 = onehotsp[:,omegaone,:].mean(1)
-    k2 = onehotsp[:,omegatwo,:].mean(1)
+    k1 = onehots(onehotsa, onehotsp, omegaone)[1].mean(1)
+    k2 = onehots(onehotsa, onehotsp, omegatwo)[1].mean(1)
     Ks = (k1[...,None] @ k2[...,None,:]).mean(0)
     eigvalsp, eigvecsp = np.linalg.eigh(Ks + Ks.T)
     return eigvalsp[-K:], eigvecsp[:,-K:]
@@ -85,11 +171,12 @@ def getEigKs(onehotsa, onehotsp, omegaone, omegatwo, K):
 #helper function to get estimates of h, 
 #  array of empirical next state probabilities given state and action,
 #  for lists of indexes of each partition of \Omega_1 and \Omega_2
-def geths(onehotsa, onehotsp, omgones, omgtwos, G):
+#  (with sparse=True a list of [csr, csr] pairs, see geth_idx)
+def geths(onehotsa, onehotsp, omgones, omgtwos, G, sparse=False):
     hs = []
     for g in tqdm(range(G)):
-        hs.append([geth(onehotsa[:,omgones[g],:,:], onehotsp[:,omgones[g],:]), 
-                   geth(onehotsa[:,omgtwos[g],:,:], onehotsp[:,omgtwos[g],:])])
-    return np.array(hs)
+        hs.append([gethWindow(onehotsa, onehotsp, omgones[g], sparse=sparse), 
+                   gethWindow(onehotsa, onehotsp, omgtwos[g], sparse=sparse)])
+    return hs if sparse else np.array(hs)
 
 
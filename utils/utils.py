@@ -3,12 +3,25 @@ Extra classes and functions for sepsis sim
 Most of the code are from https://github.com/clinicalml/gumbel-max-scm
 """
 import numpy as np
+import scipy.sparse as sp
 import utils.mdptoolboxSrc.mdp as mdptools
 import matplotlib.pyplot as plt
 
+def to_csr_lists(mat):
+    """Convert a (n_components x) n_actions x n_states x n_states array, or
+    nested lists of (sparse) matrices, into n_components x n_actions nested
+    lists of csr_matrix
+    """
+    if isinstance(mat, np.ndarray) and mat.ndim == 3:
+        mat = mat[np.newaxis, ...]
+    elif not isinstance(mat, np.ndarray) and sp.issparse(mat[0]):
+        mat = [mat]
+    return [[sp.csr_matrix(m_a) for m_a in m_c] for m_c in mat]
+
 class MatrixMDP(object):
 
-    def __init__(self, tx_mat, r_mat, p_initial_state=None, p_mixture=None):
+    def __init__(self, tx_mat, r_mat, p_initial_state=None, p_mixture=None,
+            sparse=False):
         """__init__
         Parameters
         ----------
@@ -19,29 +32,44 @@ class MatrixMDP(object):
         p_initial_state : Probability over initial states
         p_mixture : Probability over "mixture" components, in this case
             diabetes status
+        sparse : bool
+            Store tx_mat / r_mat as (n_components x n_actions) nested lists
+            of csr_matrix. Dense arrays or such nested lists can be passed.
         """
-        # QA the size of the inputs
-        assert tx_mat.ndim == 3, \
-            "Transition matrix wrong dims ({} != 3 or 4)".format(tx_mat.ndim)
-        assert r_mat.ndim == 3, \
-            "Reward matrix wrong dims ({} != 3 or 4)".format(tx_mat.ndim)
-        assert r_mat.shape == tx_mat.shape, \
-            "Transition / Reward matricies not the same shape!"
-        assert tx_mat.shape[-1] == tx_mat.shape[-2], \
-            "Last two dims of Tx matrix should be equal to num of states"
-
-        # Get the number of actions and states
-        n_actions = tx_mat.shape[-3]
-        n_states = tx_mat.shape[-2]
-
-        # Get the number of components in the mixture:
-        # If no hidden component, add a dummy so the rest of the interface works
-        if tx_mat.ndim == 3:
-            n_components = 1
-            tx_mat = tx_mat[np.newaxis, ...]
-            r_mat = r_mat[np.newaxis, ...]
+        if sparse:
+            tx_mat = to_csr_lists(tx_mat)
+            r_mat = to_csr_lists(r_mat)
+            assert len(r_mat) == len(tx_mat) and \
+                len(r_mat[0]) == len(tx_mat[0]), \
+                "Transition / Reward matricies not the same shape!"
+            assert tx_mat[0][0].shape[0] == tx_mat[0][0].shape[1], \
+                "Last two dims of Tx matrix should be equal to num of states"
+            n_components = len(tx_mat)
+            n_actions = len(tx_mat[0])
+            n_states = tx_mat[0][0].shape[0]
         else:
-            n_components = tx_mat.shape[0]
+            # QA the size of the inputs
+            assert tx_mat.ndim == 3, \
+                "Transition matrix wrong dims ({} != 3 or 4)".format(tx_mat.ndim)
+            assert r_mat.ndim == 3, \
+                "Reward matrix wrong dims ({} != 3 or 4)".format(tx_mat.ndim)
+            assert r_mat.shape == tx_mat.shape, \
+                "Transition / Reward matricies not the same shape!"
+            assert tx_mat.shape[-1] == tx_mat.shape[-2], \
+                "Last two dims of Tx matrix should be equal to num of states"
+
+            # Get the number of actions and states
+            n_actions = tx_mat.shape[-3]
+            n_states = tx_mat.shape[-2]
+
+            # Get the number of components in the mixture:
+            # If no hidden component, add a dummy so the rest of the interface works
+            if tx_mat.ndim == 3:
+                n_components = 1
+                tx_mat = tx_mat[np.newaxis, ...]
+                r_mat = r_mat[np.newaxis, ...]
+            else:
+                n_components = tx_mat.shape[0]
 
         # Get the prior over initial states
         if p_initial_state is not None:
@@ -67,6 +95,7 @@ class MatrixMDP(object):
         self.r_mat = r_mat
         self.p_initial_state = p_initial_state
         self.p_mixture = p_mixture
+        self.sparse = sparse
 
         self.current_state = None
         self.component = None
@@ -114,16 +143,28 @@ class MatrixMDP(object):
         assert action in range(self.n_actions), "Invalid action!"
         is_term = False
 
-        next_prob = self.tx_mat[
-                self.component, action, self.current_state,
-                :].squeeze()
+        if self.sparse:
+            # Only sample among the stored (nonzero) entries of the row
+            tx = self.tx_mat[self.component][action]
+            row = slice(tx.indptr[self.current_state],
+                        tx.indptr[self.current_state + 1])
+            next_prob = tx.data[row]
+            assert np.isclose(next_prob.sum(), 1), "Probs do not sum to 1!"
+            next_state = tx.indices[row][
+                np.random.choice(len(next_prob), size=1, p=next_prob)[0]]
+            reward = self.r_mat[self.component][action][
+                self.current_state, next_state]
+        else:
+            next_prob = self.tx_mat[
+                    self.component, action, self.current_state,
+                    :].squeeze()
 
-        assert np.isclose(next_prob.sum(), 1), "Probs do not sum to 1!"
+            assert np.isclose(next_prob.sum(), 1), "Probs do not sum to 1!"
 
-        next_state = np.random.choice(self.n_states, size=1, p=next_prob)[0]
+            next_state = np.random.choice(self.n_states, size=1, p=next_prob)[0]
 
-        reward = self.r_mat[self.component, action,
-                            self.current_state, next_state]
+            reward = self.r_mat[self.component, action,
+                                self.current_state, next_state]
         self.current_state = next_state
 
         # In this MDP, rewards are only received at the terminal state
@@ -132,6 +173,30 @@ class MatrixMDP(object):
 
         return self.current_state, reward, is_term
 
+    def marginalMats(self):
+        """Marginalize tx_mat and r_mat over the mixture components
+
+        Returns
+        -------
+        (tx_mat_obs, r_mat_obs) : (n_actions x n_states x n_states) arrays,
+            or per-action lists of csr_matrix when the MDP is sparse
+        """
+        if not self.sparse:
+            r_mat_obs = self.r_mat.T.dot(self.p_mixture).T
+            tx_mat_obs = self.tx_mat.T.dot(self.p_mixture).T
+            return tx_mat_obs, r_mat_obs
+
+        def marginalize(mats):
+            mats_obs = []
+            for a in range(self.n_actions):
+                m_a = mats[0][a] * self.p_mixture[0]
+                for c in range(1, self.n_components):
+                    m_a = m_a + mats[c][a] * self.p_mixture[c]
+                mats_obs.append(sp.csr_matrix(m_a))
+            return mats_obs
+
+        return marginalize(self.tx_mat), marginalize(self.r_mat)
+
     def policyIteration(self, discount=0.9, obs_pol=None, skip_check=False,
             eval_type=1):
         """Calculate the optimal policy for the marginal tx_mat and r_mat,
@@ -150,8 +215,7 @@ class MatrixMDP(object):
             Determninistic optimal policy 
         """
         # Define the marginalized transition and reward matrix
-        r_mat_obs = self.r_mat.T.dot(self.p_mixture).T
-        tx_mat_obs = self.tx_mat.T.dot(self.p_mixture).T
+        tx_mat_obs, r_mat_obs = self.marginalMats()
 
         # Run Policy Iteration
         pi = mdptools.PolicyIteration(
@@ -184,8 +248,7 @@ class MatrixMDP(object):
             Value for each state
         """
         # Define the marginalized transition and reward matrix
-        r_mat_obs = self.r_mat.T.dot(self.p_mixture).T
-        tx_mat_obs = self.tx_mat.T.dot(self.p_mixture).T
+        tx_mat_obs, r_mat_obs = self.marginalMats()
 
         # Run Policy Iteration
         pi = mdptools.ValueIteration(